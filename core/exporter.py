@@ -1,3 +1,4 @@
+import os
 from abc import ABC, abstractmethod
 
 import logging
@@ -61,14 +62,32 @@ class ExporterBase(ABC):
 
 
 class ExporterOpenCV(ExporterBase):
-    def __init__(self, name='open_cv'):
+    def __init__(self, name='open_cv', jpeg_quality: int = None):
         super().__init__()
         self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
         self.name = name
+        self.jpeg_quality = jpeg_quality
 
     def _export(self, image):
-        image = np.clip(image.raw_image, 0, 2**8-1)
-        image = image.astype(dtype=np.uint8)
+        if image.raw_image.dtype == np.uint8:
+            image = image.raw_image
+        else:
+            image = np.clip(image.raw_image, 0, 2**8-1)
+            image = image.astype(dtype=np.uint8)
         if len(image.shape) == 3:
             image = image[:, :, ::-1]
-        cv2.imwrite(self.path_to_export_image, image)
+        parameters = []
+        if self.jpeg_quality is not None and self.path_to_export_image.lower().endswith(('.jpg', '.jpeg')):
+            parameters = [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality]
+        # Written next to the target and renamed, a reader or a retried job never sees a partially written image.
+        directory, file_name = os.path.split(self.path_to_export_image)
+        path_to_temporary_image = os.path.join(directory, f".{os.getpid()}.{file_name}")
+        if not cv2.imwrite(path_to_temporary_image, image, parameters):
+            self.logger.error(f"Could not write {self.path_to_export_image}")
+            raise ValueError
+        os.replace(path_to_temporary_image, self.path_to_export_image)
+
+    def set(self, name=None, path_to_export_image=None, jpeg_quality=None):
+        super()._set(name, path_to_export_image)
+        if jpeg_quality is not None:
+            self.jpeg_quality = jpeg_quality
@@ -1,14 +1,84 @@
+import os
+import sys
+import atexit
 import logging
+import tempfile
 
 import numpy as np
 import numpy.typing as npt
 
+from copy import deepcopy
+from multiprocessing import shared_memory, resource_tracker, util
+
 
 class Image:
-    def __init__(self, raw_image: npt.NDArray[np.float32], camera_white_balance=None):
+    def __init__(self, raw_image: npt.NDArray[np.float32], camera_white_balance=None, color_matrix=None,
+                 camera_id: str = None):
         self.logger = logging.getLogger(f"eremore.{__name__}")
         self.raw_image = raw_image
         self.camera_white_balance = camera_white_balance
+        self.color_matrix = color_matrix
+        self.camera_id = camera_id
+        self._shared_memory = None
+
+    def share(self, backing: str = 'shared_memory', directory: str = None) -> 'ImageHandle':
+        # Moves raw_image into a shared memory segment or a memory mapped scratch file and returns a small picklable
+        # handle, other processes attach to it instead of receiving a copy of the whole array.
+        if backing == 'shared_memory':
+            segment = SharedSegments.create(max(self.raw_image.nbytes, 1))
+            raw_image = np.ndarray(self.raw_image.shape, dtype=self.raw_image.dtype, buffer=segment.buf)
+            name = segment.name
+        elif backing == 'memmap':
+            file_descriptor, name = tempfile.mkstemp(prefix='eremore_', suffix='.raw', dir=directory)
+            os.close(file_descriptor)
+            segment = None
+            raw_image = np.memmap(name, dtype=self.raw_image.dtype, mode='w+', shape=self.raw_image.shape)
+        else:
+            self.logger.error(f"Wrong value of backing: {backing}")
+            raise ValueError
+
+        raw_image[...] = self.raw_image
+        self.close()
+        self.raw_image = raw_image
+        self._shared_memory = segment
+        SharedSegments.add(backing, name)
+        self.logger.debug(f"Shared raw image with -> backing: {backing} | name: {name}")
+        return ImageHandle(backing, name, raw_image.shape, raw_image.dtype.str,
+                           camera_white_balance=self.camera_white_balance, color_matrix=self.color_matrix,
+                           camera_id=self.camera_id)
+
+    def close(self):
+        # Releases the mapping of a shared raw_image, the segment itself is removed by ImageHandle.unlink.
+        self.raw_image = None
+        if self._shared_memory is not None:
+            self._shared_memory.close()
+            self._shared_memory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __deepcopy__(self, memo):
+        image = Image.__new__(Image)
+        for key, value in vars(self).items():
+            if key == '_shared_memory':
+                value = None
+            elif key == 'raw_image' and value is not None:
+                value = np.array(value)
+            else:
+                value = deepcopy(value, memo)
+            setattr(image, key, value)
+        return image
+
+    def __getstate__(self):
+        # Pickling a shared image copies its data, pass ImageHandle between processes instead.
+        state = dict(vars(self))
+        state['_shared_memory'] = None
+        if state['raw_image'] is not None:
+            state['raw_image'] = np.asarray(state['raw_image'])
+        return state
 
     def __str__(self):
         return str({'shape': self.raw_image.shape,
@@ -17,3 +87,104 @@ class Image:
     def __repr__(self):
         return self.__str__()
 
+
+class ImageHandle:
+    def __init__(self, backing: str, name: str, shape, dtype: str, camera_white_balance=None, color_matrix=None,
+                 camera_id: str = None):
+        self.backing = backing
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.camera_white_balance = camera_white_balance
+        self.color_matrix = color_matrix
+        self.camera_id = camera_id
+
+    def attach(self) -> Image:
+        if self.backing == 'shared_memory':
+            segment = SharedSegments.open(self.name)
+            raw_image = np.ndarray(self.shape, dtype=np.dtype(self.dtype), buffer=segment.buf)
+        else:
+            segment = None
+            raw_image = np.memmap(self.name, dtype=np.dtype(self.dtype), mode='r+', shape=self.shape)
+        image = Image(raw_image,
+                      camera_white_balance=deepcopy(self.camera_white_balance),
+                      color_matrix=deepcopy(self.color_matrix),
+                      camera_id=self.camera_id)
+        image._shared_memory = segment
+        return image
+
+    def unlink(self):
+        SharedSegments.unlink(self.backing, self.name)
+
+    def __str__(self):
+        return str({'backing': self.backing, 'name': self.name, 'shape': self.shape, 'type': self.dtype})
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class SharedSegments:
+    # Segments created by this process, whatever is not unlinked by a consumer is removed when the process exits.
+    logger = logging.getLogger(f"eremore.{__name__}.shared_segments")
+    created = set()
+    _cleanup_registered = False
+
+    @staticmethod
+    def add(backing, name):
+        if not SharedSegments._cleanup_registered:
+            # multiprocessing children leave through os._exit and skip atexit, they run the finalizers instead.
+            atexit.register(SharedSegments.unlink_all)
+            util.Finalize(None, SharedSegments.unlink_all, exitpriority=0)
+            SharedSegments._cleanup_registered = True
+        SharedSegments.created.add((backing, name))
+
+    @staticmethod
+    def _reset_after_fork():
+        # A forked child owns none of the segments of its parent and has not registered its own cleanup yet.
+        SharedSegments.created = set()
+        SharedSegments._cleanup_registered = False
+
+    # The lifetime is managed here and not by the multiprocessing resource tracker, which would remove a segment as
+    # soon as any process that merely attached to it exits and which is shared with child processes.
+    @staticmethod
+    def create(size):
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(create=True, size=size, track=False)
+        segment = shared_memory.SharedMemory(create=True, size=size)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+    @staticmethod
+    def open(name):
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(name=name, track=False)
+        segment = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+    @staticmethod
+    def unlink(backing, name):
+        SharedSegments.created.discard((backing, name))
+        try:
+            if backing == 'shared_memory':
+                if sys.version_info >= (3, 13):
+                    segment = shared_memory.SharedMemory(name=name, track=False)
+                else:
+                    # Registered with the resource tracker here and unregistered again by unlink.
+                    segment = shared_memory.SharedMemory(name=name)
+                segment.close()
+                segment.unlink()
+            else:
+                os.remove(name)
+        except FileNotFoundError:
+            SharedSegments.logger.debug(f"Shared segment {name} already unlinked.")
+
+    @staticmethod
+    def unlink_all():
+        for backing, name in list(SharedSegments.created):
+            SharedSegments.logger.debug(f"Unlinking leftover shared segment {name}.")
+            SharedSegments.unlink(backing, name)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=SharedSegments._reset_after_fork)
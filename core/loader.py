@@ -13,6 +13,10 @@ from helper.run_and_measure_time import run_and_measure_time
 
 from core.image import Image
 
+XYZ_FROM_SRGB = np.asarray([[0.412453, 0.357580, 0.180423],
+                            [0.212671, 0.715160, 0.072169],
+                            [0.019334, 0.119193, 0.950227]], dtype=np.float32)
+
 
 class Loader:
     def __init__(self, name: str = 'exporter', engine: str = 'open_cv'):
@@ -35,6 +39,8 @@ class LoaderBase(ABC):
         self.logger = logging.getLogger(f"eremore.{__name__}")
         self.name = None
         self.path_to_raw_image = None
+        # Identifies the camera body for per camera calibrations, the RAW metadata read by rawpy has no serial number.
+        self.camera_id = None
 
     def load(self) -> Image:
         if self.path_to_raw_image is None:
@@ -49,15 +55,28 @@ class LoaderBase(ABC):
     def _load(self) -> Image:
         pass
 
-    def set(self, name=None, path_to_raw_image=None):
-        self._set(name, path_to_raw_image)
+    def get_shape(self):
+        # Shape of the raw image read from the file header, without decoding it.
+        if self.path_to_raw_image is None:
+            self.logger.warning(f"path_to_raw_image not set, returning placeholder shape.")
+            return 64, 64
+        return self._get_shape()
 
-    def _set(self, name=None, path_to_raw_image=None):
+    @abstractmethod
+    def _get_shape(self):
+        pass
+
+    def set(self, name=None, path_to_raw_image=None, camera_id=None):
+        self._set(name, path_to_raw_image, camera_id)
+
+    def _set(self, name=None, path_to_raw_image=None, camera_id=None):
         if name is not None:
             self.name = name
             self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
         if path_to_raw_image is not None:
             self.path_to_raw_image = path_to_raw_image
+        if camera_id is not None:
+            self.camera_id = camera_id
 
 
 class LoaderRawPy(LoaderBase):
@@ -68,7 +87,26 @@ class LoaderRawPy(LoaderBase):
 
     def _load(self):
         with rawpy.imread(self.path_to_raw_image) as rawpy_loader:
-            raw_image = rawpy_loader.raw_image.copy()
-            image = Image(raw_image.astype(np.uint16),
-                          camera_white_balance=np.asarray(rawpy_loader.camera_whitebalance[:3], dtype=np.float32))
+            image = Image(rawpy_loader.raw_image.astype(np.uint16),
+                          camera_white_balance=np.asarray(rawpy_loader.camera_whitebalance[:3], dtype=np.float32),
+                          color_matrix=self._get_color_matrix(rawpy_loader),
+                          camera_id=self.camera_id)
         return image
+
+    def _get_shape(self):
+        with rawpy.RawPy() as rawpy_loader:
+            rawpy_loader.open_file(self.path_to_raw_image)
+            return rawpy_loader.sizes.raw_height, rawpy_loader.sizes.raw_width
+
+    def _get_color_matrix(self, rawpy_loader):
+        # Camera RGB -> sRGB, rawpy calculates it for most cameras, otherwise derive it from the camera RGB -> XYZ one.
+        color_matrix = np.asarray(rawpy_loader.color_matrix, dtype=np.float32)[:, :3]
+        if np.any(color_matrix):
+            return color_matrix
+        camera_xyz = np.asarray(rawpy_loader.rgb_xyz_matrix, dtype=np.float32)[:3, :]
+        if not np.any(camera_xyz):
+            self.logger.warning(f"No color matrix found in the raw image.")
+            return None
+        camera_rgb = camera_xyz @ XYZ_FROM_SRGB
+        camera_rgb /= np.sum(camera_rgb, axis=1, keepdims=True)
+        return np.linalg.inv(camera_rgb).astype(dtype=np.float32)
@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import socket
+import hashlib
+import logging
+import threading
+
+
+class SpoolQueue:
+    # A job queue kept in a directory, usable by workers on several hosts sharing the file system. A job is a JSON
+    # file moved between the state directories by os.rename, which is atomic, so exactly one worker claims a job.
+    # The modification time of a running job is its heartbeat.
+    states = ('pending', 'running', 'done', 'failed')
+
+    def __init__(self, directory: str, name: str = 'spool_queue'):
+        self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
+        self.name = name
+        self.directory = directory
+        for state in self.states + ('tmp',):
+            os.makedirs(os.path.join(self.directory, state), exist_ok=True)
+
+    @staticmethod
+    def get_job_id(argv):
+        # The same arguments always give the same job, submitting them again does not duplicate it.
+        return hashlib.sha1(json.dumps(list(argv)).encode()).hexdigest()[:16]
+
+    def submit(self, argv, metadata=None):
+        job_id = self.get_job_id(argv)
+        if self.get_state(job_id) is not None:
+            self.logger.debug(f"Job {job_id} already submitted.")
+            return job_id
+        self._write_job({'id': job_id, 'argv': list(argv), 'attempts': 0, 'metadata': metadata or {}})
+        os.rename(os.path.join(self.directory, 'tmp', f"{job_id}.json"), self._get_path_to_job('pending', job_id))
+        return job_id
+
+    def claim(self):
+        for file_name in sorted(os.listdir(os.path.join(self.directory, 'pending'))):
+            job_id = file_name[:-len('.json')]
+            try:
+                os.rename(self._get_path_to_job('pending', job_id), self._get_path_to_job('running', job_id))
+            except FileNotFoundError:
+                # Claimed by another worker in the meantime.
+                continue
+            try:
+                # A renamed file keeps the modification time of its submission, refresh it before it looks stale.
+                self.heartbeat(job_id)
+                with open(self._get_path_to_job('running', job_id)) as file:
+                    return json.load(file)
+            except FileNotFoundError:
+                continue
+        return None
+
+    def heartbeat(self, job_id):
+        os.utime(self._get_path_to_job('running', job_id))
+
+    def complete(self, job_id):
+        return self._move(job_id, 'running', 'done')
+
+    def fail(self, job_id):
+        return self._move(job_id, 'running', 'failed')
+
+    def retry(self, job):
+        # The running job file is replaced by one with the attempt counted, then put back to pending.
+        self._write_job(job)
+        try:
+            os.replace(os.path.join(self.directory, 'tmp', f"{job['id']}.json"),
+                       self._get_path_to_job('running', job['id']))
+        except FileNotFoundError:
+            return False
+        return self._move(job['id'], 'running', 'pending')
+
+    def requeue_stale(self, stale_timeout: float):
+        # Jobs of workers that stopped heart beating are put back, a worker that is merely late finds its job gone.
+        requeued = []
+        now = time.time()
+        for file_name in os.listdir(os.path.join(self.directory, 'running')):
+            job_id = file_name[:-len('.json')]
+            try:
+                if now - os.path.getmtime(self._get_path_to_job('running', job_id)) < stale_timeout:
+                    continue
+            except FileNotFoundError:
+                continue
+            if self._move(job_id, 'running', 'pending'):
+                self.logger.warning(f"Requeued stale job {job_id}.")
+                requeued.append(job_id)
+        return requeued
+
+    def get_state(self, job_id):
+        for state in self.states:
+            if os.path.exists(self._get_path_to_job(state, job_id)):
+                return state
+        return None
+
+    def get_counts(self):
+        return {state: len(os.listdir(os.path.join(self.directory, state))) for state in self.states}
+
+    def _move(self, job_id, source_state, target_state):
+        try:
+            os.rename(self._get_path_to_job(source_state, job_id), self._get_path_to_job(target_state, job_id))
+        except FileNotFoundError:
+            self.logger.warning(f"Job {job_id} is no longer {source_state}, it was probably requeued.")
+            return False
+        return True
+
+    def _write_job(self, job):
+        with open(os.path.join(self.directory, 'tmp', f"{job['id']}.json"), 'w') as file:
+            json.dump(job, file)
+
+    def _get_path_to_job(self, state, job_id):
+        return os.path.join(self.directory, state, f"{job_id}.json")
+
+
+class SpoolManifest:
+    # Outcomes of the jobs, each worker appends to its own JSON lines file so no locking is needed. The last record of
+    # a job is its current outcome, jobs without a record are still pending or running.
+    def __init__(self, directory: str, worker_id: str = None, name: str = 'spool_manifest'):
+        self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
+        self.name = name
+        self.directory = os.path.join(directory, 'manifest')
+        self.worker_id = worker_id
+        os.makedirs(self.directory, exist_ok=True)
+
+    def record(self, job, state: str, elapsed_time: float, error: str = None, **fields):
+        entry = {'id': job['id'], 'state': state, 'attempt': job.get('attempts', 0) + 1,
+                 'elapsed_time': round(elapsed_time, 3), 'error': error, 'worker': self.worker_id,
+                 'time': time.time(), **job.get('metadata', {}), **fields}
+        # Flushed to disk before the job changes state, a crash right after still leaves the outcome recorded.
+        with open(os.path.join(self.directory, f"{self.worker_id}.jsonl"), 'a') as file:
+            file.write(json.dumps(entry) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+    def load(self):
+        entries = {}
+        for file_name in sorted(os.listdir(self.directory)):
+            with open(os.path.join(self.directory, file_name)) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line of a worker killed while writing.
+                        continue
+                    if entry['id'] not in entries or entries[entry['id']]['time'] <= entry['time']:
+                        entries[entry['id']] = entry
+        return entries
+
+
+class Heartbeat:
+    # Touches a running job from a background thread while the job is processed.
+    def __init__(self, spool_queue: SpoolQueue, job_id: str, interval: float):
+        self.spool_queue = spool_queue
+        self.job_id = job_id
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.spool_queue.heartbeat(self.job_id)
+            except FileNotFoundError:
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop_event.set()
+        self._thread.join()
+
+
+def get_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
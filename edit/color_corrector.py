@@ -0,0 +1,245 @@
+from abc import ABC, abstractmethod
+
+import logging
+
+import numpy as np
+
+from collections import OrderedDict
+
+from helper.get_attributes import get_attributes
+from helper.run_and_measure_time import run_and_measure_time
+from helper.get_buffer import get_buffer
+
+from core.image import Image
+
+from edit import jit_kernels
+
+
+class ColorCorrector:
+    def __init__(self, name: str = 'color_corrector', engine: str = None):
+        self.logger = logging.getLogger(f"eremore.{__name__}")
+        self.name = name
+        self.engine = engine
+        self.engines = OrderedDict()
+        self.engines['matrix'] = ColorCorrectorMatrix()
+        self.engines['lut_3d'] = ColorCorrectorLUT3D()
+        self.engines['lut_3d_jit'] = ColorCorrectorLUT3DJIT()
+
+    def process(self, image: Image):
+        if self.engine is None:
+            return
+        if self.engine not in self.engines.keys():
+            self.logger.error(f"ColorCorrector engine {self.engine} does not exists.")
+            raise ValueError
+
+        self.engines[self.engine].color_correct(image)
+
+
+class ColorCorrectorBase(ABC):
+    def __init__(self,
+                 input_black_level: int = 0, input_white_level: int = 2**12-1,
+                 output_black_level: int = 0, output_white_level: int = 2**12-1,
+                 gamma: float = 1.0):
+        self.logger = logging.getLogger(f"eremore.{__name__}")
+        self.name = None
+        self.input_black_level = input_black_level
+        self.input_white_level = input_white_level
+        self.output_black_level = output_black_level
+        self.output_white_level = output_white_level
+        self.gamma = gamma
+        self.reuse_buffers = False
+        self._buffers = {}
+
+    def color_correct(self, image: Image):
+        attributes = get_attributes(self)
+        arguments = {'image': image}
+        self.logger.debug(f"Color correcting with -> attributes: {attributes} | arguments: {arguments}")
+        run_and_measure_time(self._color_correct, arguments, logger=self.logger)
+
+    @abstractmethod
+    def _color_correct(self, image: Image):
+        pass
+
+    def _get_color_matrix(self, image: Image):
+        if image.color_matrix is None or np.shape(image.color_matrix) != (3, 3):
+            self.logger.warning(f"No color matrix could be read from the raw image, applying only gamma.")
+            return np.eye(3, dtype=np.float32)
+        return np.asarray(image.color_matrix, dtype=np.float32)
+
+    def _transform(self, values, color_matrix):
+        return self._encode(self._transform_linear(values, color_matrix))
+
+    def _transform_linear(self, values, color_matrix):
+        values = values.astype(dtype=np.float32)
+        values -= self.input_black_level
+        values /= self.input_white_level - self.input_black_level
+        return values @ np.transpose(color_matrix)
+
+    def _encode(self, values):
+        values = np.clip(values, 0.0, 1.0)
+        values **= self.gamma
+        values *= self.output_white_level - self.output_black_level
+        values += self.output_black_level
+        return values
+
+    def set(self,
+            name=None,
+            input_black_level=None, input_white_level=None,
+            output_black_level=None, output_white_level=None,
+            gamma=None):
+        self._set(name,
+                  input_black_level, input_white_level,
+                  output_black_level, output_white_level,
+                  gamma)
+
+    def _set(self,
+             name=None,
+             input_black_level=None, input_white_level=None,
+             output_black_level=None, output_white_level=None,
+             gamma=None):
+        if name is not None:
+            self.name = name
+            self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
+        if input_black_level is not None:
+            self.input_black_level = input_black_level
+        if input_white_level is not None:
+            self.input_white_level = input_white_level
+        if output_black_level is not None:
+            self.output_black_level = output_black_level
+        if output_white_level is not None:
+            self.output_white_level = output_white_level
+        if gamma is not None:
+            self.gamma = gamma
+
+
+class ColorCorrectorMatrix(ColorCorrectorBase):
+    def __init__(self, name='matrix'):
+        super().__init__()
+        self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
+        self.name = name
+
+    def _color_correct(self, image: Image):
+        color_matrix = self._get_color_matrix(image)
+        input_raw_image = np.clip(image.raw_image, self.input_black_level, self.input_white_level)
+        out_raw_image = np.round(self._transform(input_raw_image, color_matrix))
+        if self.reuse_buffers:
+            image.raw_image = get_buffer(self._buffers, 'out', out_raw_image.shape, np.uint16)
+            np.copyto(image.raw_image, out_raw_image, casting='unsafe')
+        else:
+            image.raw_image = out_raw_image.astype(dtype=np.uint16)
+
+
+class ColorCorrectorLUT3D(ColorCorrectorBase):
+    # LUTs are shared by all instances, the color matrix identifies the camera model.
+    _lut_cache = OrderedDict()
+    _lut_cache_size = 8
+    _chunk_size = 2**14
+    _output_table_size = 2**18
+
+    def __init__(self, name='lut_3d', lut_size: int = 33):
+        super().__init__()
+        self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
+        self.name = name
+        self.lut_size = lut_size
+
+    def _color_correct(self, image: Image):
+        shaper_offsets, shaper_fractions, lut, output_table = self._get_lut(self._get_color_matrix(image))
+        input_raw_image = image.raw_image.reshape(-1, 3)
+        if self.reuse_buffers:
+            out_raw_image = get_buffer(self._buffers, 'out', input_raw_image.shape, np.uint16)
+        else:
+            out_raw_image = np.empty(input_raw_image.shape, dtype=np.uint16)
+        for start in range(0, input_raw_image.shape[0], self._chunk_size):
+            end = start + self._chunk_size
+            out_raw_image[start:end] = self._interpolate(shaper_offsets, shaper_fractions, lut, output_table,
+                                                         input_raw_image[start:end])
+        image.raw_image = out_raw_image.reshape(image.raw_image.shape)
+
+    def _interpolate(self, shaper_offsets, shaper_fractions, lut, output_table, values):
+        base_index = np.take(shaper_offsets[0], values[:, 0], mode='clip')
+        base_index += np.take(shaper_offsets[1], values[:, 1], mode='clip')
+        base_index += np.take(shaper_offsets[2], values[:, 2], mode='clip')
+        fractions = [np.expand_dims(np.take(shaper_fractions, values[:, c], mode='clip'), axis=1) for c in range(3)]
+
+        # Reduce the 8 cell corners one axis at a time, blue first, each lerp done in place.
+        strides = (self.lut_size**2, self.lut_size, 1)
+        corners = [np.take(lut, base_index + offset, axis=0)
+                   for offset in (r * strides[0] + g * strides[1] + b * strides[2]
+                                  for r in (0, 1) for g in (0, 1) for b in (0, 1))]
+        for c in (2, 1, 0):
+            for i in range(0, len(corners), 2):
+                corners[i + 1] -= corners[i]
+                corners[i + 1] *= fractions[c]
+                corners[i] += corners[i + 1]
+            corners = corners[::2]
+        out_values = corners[0]
+        out_values += 0.5
+        return np.take(output_table, out_values.astype(dtype=np.intp), mode='clip')
+
+    def _get_lut(self, color_matrix):
+        key = (color_matrix.tobytes(), self.lut_size, self.gamma,
+               self.input_black_level, self.input_white_level,
+               self.output_black_level, self.output_white_level)
+        if key in self._lut_cache:
+            self._lut_cache.move_to_end(key)
+            return self._lut_cache[key]
+
+        # The LUT holds the unclipped linear color transform in output table positions, the clipping and the output
+        # gamma are applied afterwards by a 1D output table. Trilinear interpolation reproduces a linear transform,
+        # the interpolation of the gamma curve across a cell would be off by tens of levels in the shadows.
+        # The shaper absorbs the black level subtraction and input clipping, it is split into the flat LUT offset of
+        # the cell per channel and the position inside the cell.
+        position = np.arange(0, self.input_white_level + 1, dtype=np.float32)
+        position = np.clip(position, self.input_black_level, self.input_white_level)
+        position -= self.input_black_level
+        position /= self.input_white_level - self.input_black_level
+        position *= self.lut_size - 1
+        cell = np.minimum(position.astype(dtype=np.intp), self.lut_size - 2)
+        shaper_offsets = np.stack([cell * self.lut_size**2, cell * self.lut_size, cell])
+        shaper_fractions = position - cell
+
+        nodes = np.linspace(self.input_black_level, self.input_white_level, self.lut_size, dtype=np.float32)
+        grid = np.stack(np.meshgrid(nodes, nodes, nodes, indexing='ij'), axis=-1).reshape(-1, 3)
+        lut = self._transform_linear(grid, color_matrix)
+        lut *= self._output_table_size - 1
+
+        output_table = self._encode(np.linspace(0.0, 1.0, self._output_table_size, dtype=np.float32))
+        output_table = np.round(output_table).astype(dtype=np.uint16)
+        self.logger.debug(f"Computed {self.lut_size}^3 LUT for color matrix {color_matrix.tolist()}")
+
+        self._lut_cache[key] = (shaper_offsets, shaper_fractions, lut, output_table)
+        if len(self._lut_cache) > self._lut_cache_size:
+            self._lut_cache.popitem(last=False)
+        return shaper_offsets, shaper_fractions, lut, output_table
+
+    def set(self,
+            name=None,
+            input_black_level=None, input_white_level=None,
+            output_black_level=None, output_white_level=None,
+            gamma=None,
+            lut_size=None):
+        super()._set(name,
+                     input_black_level, input_white_level,
+                     output_black_level, output_white_level,
+                     gamma)
+        if lut_size is not None:
+            self.lut_size = lut_size
+
+
+class ColorCorrectorLUT3DJIT(ColorCorrectorLUT3D):
+    def __init__(self, name='lut_3d_jit', lut_size: int = 33):
+        super().__init__(name=name, lut_size=lut_size)
+
+    def _color_correct(self, image: Image):
+        if not jit_kernels.JIT_AVAILABLE:
+            jit_kernels.warn_fallback(type(self).__name__)
+            return super()._color_correct(image)
+        shaper_offsets, shaper_fractions, lut, output_table = self._get_lut(self._get_color_matrix(image))
+        input_raw_image = np.ascontiguousarray(image.raw_image).reshape(-1, 3)
+        if self.reuse_buffers:
+            out_raw_image = get_buffer(self._buffers, 'out', input_raw_image.shape, np.uint16)
+        else:
+            out_raw_image = np.empty(input_raw_image.shape, dtype=np.uint16)
+        jit_kernels.lut_3d_trilinear(shaper_offsets, shaper_fractions, lut, self.lut_size, output_table,
+                                     input_raw_image, out_raw_image)
+        image.raw_image = out_raw_image.reshape(image.raw_image.shape)
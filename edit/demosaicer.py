@@ -2,7 +2,7 @@ from abc import ABC, abstractmethod
 
 import logging
 
-import scipy
+import scipy.signal
 import numpy as np
 
 from typing import Tuple
@@ -10,9 +10,12 @@ from collections import OrderedDict
 
 from helper.get_attributes import get_attributes
 from helper.run_and_measure_time import run_and_measure_time
+from helper.get_buffer import get_buffer
 
 from core.image import Image
 
+from edit import jit_kernels
+
 
 class Demosaicer:
     def __init__(self, name: str = 'demosaicer', engine: str = None):
@@ -23,6 +26,9 @@ class Demosaicer:
         self.engines['bayer_splitter'] = BayerSplitter()
         self.engines['copy'] = DemosaicerCopy()
         self.engines['linear'] = DemosaicerLinear()
+        self.engines['linear_fixed_point'] = DemosaicerLinearFixedPoint()
+        self.engines['bayer_splitter_jit'] = BayerSplitterJIT()
+        self.engines['linear_jit'] = DemosaicerLinearJIT()
 
     def process(self, image: Image):
         if self.engine is None:
@@ -33,12 +39,25 @@ class Demosaicer:
 
         self.engines[self.engine].demosaice(image)
 
+    def get_input_roi(self, roi, shape):
+        if self.engine is None:
+            return roi
+        return self.engines[self.engine].get_input_roi(roi, shape)
+
 
 class DemosaicerBase(ABC):
+    # Distance in pixels of the farthest raw neighbour used to interpolate a pixel.
+    halo = 0
+
     def __init__(self, blue_loc: Tuple[int, int] = (1, 1)):
         self.logger = logging.getLogger(f"eremore.{__name__}")
         self.name = None
         self.blue_loc = blue_loc
+        self.reuse_buffers = False
+        self._buffers = {}
+        self._update_color_locs()
+
+    def _update_color_locs(self):
         if self.blue_loc == (0, 0):
             self._red_loc = (1, 1)
             self._green_x_loc = (1, 0)
@@ -52,7 +71,7 @@ class DemosaicerBase(ABC):
             self._red_loc = (0, 0)
             self._green_x_loc = (1, 0)
         else:
-            self.logger.error(f"Wrong value of blue_loc: {blue_loc}")
+            self.logger.error(f"Wrong value of blue_loc: {self.blue_loc}")
             raise ValueError
 
     def demosaice(self, image: Image):
@@ -65,6 +84,15 @@ class DemosaicerBase(ABC):
     def _demosaice(self, image: Image):
         pass
 
+    def get_input_roi(self, roi, shape):
+        # The region is grown by the halo and aligned to the 2x2 Bayer grid, so blue_loc stays valid for the crop.
+        x, y, width, height = roi
+        x0 = max(x - self.halo, 0) // 2 * 2
+        y0 = max(y - self.halo, 0) // 2 * 2
+        x1 = min((x + width + self.halo + 1) // 2 * 2, shape[1])
+        y1 = min((y + height + self.halo + 1) // 2 * 2, shape[0])
+        return x0, y0, x1 - x0, y1 - y0
+
     def set(self, name=None, blue_loc=None):
         self._set(name, blue_loc)
 
@@ -74,6 +102,7 @@ class DemosaicerBase(ABC):
             self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
         if blue_loc is not None:
             self.blue_loc = blue_loc
+            self._update_color_locs()
 
 
 class BayerSplitter(DemosaicerBase):
@@ -83,7 +112,11 @@ class BayerSplitter(DemosaicerBase):
     def _demosaice(self, image: Image):
         input_raw_image = image.raw_image
         height, width = input_raw_image.shape
-        out_raw_image = np.zeros((height, width, 3), dtype=np.uint16)
+        if self.reuse_buffers:
+            out_raw_image = get_buffer(self._buffers, 'bayer', (height, width, 3), np.uint16)
+            out_raw_image.fill(0)
+        else:
+            out_raw_image = np.zeros((height, width, 3), dtype=np.uint16)
 
         for color_loc, color_c in zip((self._red_loc, self.blue_loc), (0, 2)):
             out_raw_image[color_loc[0]::2, color_loc[1]::2, color_c] = input_raw_image[color_loc[0]::2,
@@ -117,6 +150,8 @@ class DemosaicerCopy(BayerSplitter):
 
 
 class DemosaicerLinear(BayerSplitter):
+    halo = 2
+
     def __init__(self, name='linear'):
         super().__init__()
         self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
@@ -124,7 +159,12 @@ class DemosaicerLinear(BayerSplitter):
 
     def _demosaice(self, image: Image):
         super()._demosaice(image)
-        image.raw_image = image.raw_image.astype(dtype=np.float32)
+        bayer_raw_image = image.raw_image
+        if self.reuse_buffers:
+            image.raw_image = get_buffer(self._buffers, 'float', bayer_raw_image.shape, np.float32)
+            np.copyto(image.raw_image, bayer_raw_image)
+        else:
+            image.raw_image = bayer_raw_image.astype(dtype=np.float32)
         red_blue_kernel_2 = np.array([[0.5, 0.5]], dtype=np.float32)
         red_blue_kernel_4 = np.array([[0.25, 0.25],
                                       [0.25, 0.25]], dtype=np.float32)
@@ -145,4 +185,80 @@ class DemosaicerLinear(BayerSplitter):
         for green_y_loc, green_x_loc in enumerate(self._green_x_loc):
             image.raw_image[green_y_loc::2, abs(green_x_loc - 1)::2, 1] = green_out[green_y_loc::2,
                                                                                     abs(green_x_loc - 1)::2]
-        image.raw_image = image.raw_image.astype(dtype=np.uint16)
+        if self.reuse_buffers:
+            np.copyto(bayer_raw_image, image.raw_image, casting='unsafe')
+            image.raw_image = bayer_raw_image
+        else:
+            image.raw_image = image.raw_image.astype(dtype=np.uint16)
+
+
+class DemosaicerLinearFixedPoint(BayerSplitter):
+    halo = 2
+
+    def __init__(self, name='linear_fixed_point'):
+        super().__init__()
+        self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
+        self.name = name
+
+    def _demosaice(self, image: Image):
+        super()._demosaice(image)
+        # Same kernels as DemosaicerLinear scaled to integers and evaluated as sums of shifted slices, the division is
+        # done by a right shift. The sums are accumulated in uint32 per color plane, never for the whole RGB image.
+        for color_loc, color_c in zip((self._red_loc, self.blue_loc), (0, 2)):
+            color_src = image.raw_image[color_loc[0]::2, color_loc[1]::2, color_c].astype(dtype=np.uint32)
+            horizontal_sum = color_src.copy()
+            horizontal_sum[:, 1:] += color_src[:, :-1]
+            vertical_sum = color_src.copy()
+            vertical_sum[1:, :] += color_src[:-1, :]
+            diagonal_sum = vertical_sum.copy()
+            diagonal_sum[:, 1:] += vertical_sum[:, :-1]
+            image.raw_image[color_loc[0]::2, abs(color_loc[1] - 1)::2, color_c] = horizontal_sum >> 1
+            image.raw_image[abs(color_loc[0] - 1)::2, color_loc[1]::2, color_c] = vertical_sum >> 1
+            image.raw_image[abs(color_loc[0] - 1)::2, abs(color_loc[1] - 1)::2, color_c] = diagonal_sum >> 2
+
+        green_src = image.raw_image[:, :, 1].astype(dtype=np.uint32)
+        green_out = np.zeros_like(green_src)
+        green_out[1:, :] += green_src[:-1, :]
+        green_out[:-1, :] += green_src[1:, :]
+        green_out[:, 1:] += green_src[:, :-1]
+        green_out[:, :-1] += green_src[:, 1:]
+        green_out >>= 2
+        for green_y_loc, green_x_loc in enumerate(self._green_x_loc):
+            image.raw_image[green_y_loc::2, abs(green_x_loc - 1)::2, 1] = green_out[green_y_loc::2,
+                                                                                    abs(green_x_loc - 1)::2]
+
+
+class DemosaicerJITMixin:
+    _kernel_name = None
+
+    def _demosaice(self, image: Image):
+        if not jit_kernels.JIT_AVAILABLE:
+            jit_kernels.warn_fallback(type(self).__name__)
+            return super()._demosaice(image)
+        input_raw_image = np.ascontiguousarray(image.raw_image)
+        height, width = input_raw_image.shape
+        if self.reuse_buffers:
+            out_raw_image = get_buffer(self._buffers, 'bayer', (height, width, 3), np.uint16)
+        else:
+            out_raw_image = np.empty((height, width, 3), dtype=np.uint16)
+        kernel = getattr(jit_kernels, self._kernel_name)
+        kernel(input_raw_image, out_raw_image, self._red_loc[0], self._red_loc[1], self.blue_loc[0], self.blue_loc[1],
+               self._green_x_loc[0], self._green_x_loc[1])
+        image.raw_image = out_raw_image
+
+
+class BayerSplitterJIT(DemosaicerJITMixin, BayerSplitter):
+    _kernel_name = 'bayer_split'
+
+    def __init__(self, name='bayer_splitter_jit'):
+        super().__init__()
+        self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
+        self.name = name
+
+
+class DemosaicerLinearJIT(DemosaicerJITMixin, DemosaicerLinear):
+    # Bayer split and bilinear interpolation fused into one pass over the Bayer array, same result as DemosaicerLinear.
+    _kernel_name = 'demosaice_linear'
+
+    def __init__(self, name='linear_jit'):
+        super().__init__(name=name)
@@ -1,10 +1,14 @@
 import logging
 
+import cv2
+import numpy as np
+
 from collections import OrderedDict
-from copy import deepcopy
+from copy import copy, deepcopy
 
 from core.image import Image
 
+from helper.bin_bayer import bin_bayer
 from helper.run_and_measure_time import run_and_measure_time
 
 
@@ -16,7 +20,10 @@ class Editor:
         self.inputs = OrderedDict()
         self.engines = OrderedDict()
         self.engines_update_state = OrderedDict()
+        self.branches = OrderedDict()
         self.output_image = None
+        self._generation = 0
+        self._statistics_images = {}
 
     def add_engine(self, engine, engine_name=None):
         if engine_name is None:
@@ -24,24 +31,241 @@ class Editor:
         self.engines[engine_name] = engine
         self.engines_update_state[engine_name] = False
 
+    def add_branch(self, branch, branch_name=None):
+        # A branch is an Editor fed with the output of this one, the shared engines run once for all branches.
+        if branch_name is None:
+            branch_name = branch.name
+        self.branches[branch_name] = branch
+        for engine_name in branch.engines.keys():
+            branch.register_engine_for_update(engine_name)
+
     def register_engine_for_update(self, engine_name):
+        # A render in flight, possibly in another thread, is superseded and stops before its next engine.
         self.engines_update_state[engine_name] = True
+        self.cancel()
+
+    def cancel(self):
+        self._generation += 1
+        for branch in self.branches.values():
+            branch.cancel()
 
     def process(self):
         run_and_measure_time(self._process, {}, logger=self.logger)
 
+    def process_progressive(self, binning: int = 4):
+        # Yields a preview rendered from the Bayer data binned by binning in both directions, then the full
+        # resolution output. Stops without yielding anything further once the render is superseded.
+        generation = self._generation
+        input_image = copy(self.input_image)
+        input_image.camera_white_balance = deepcopy(self.input_image.camera_white_balance)
+        input_image.raw_image = bin_bayer(self.input_image.raw_image, binning)
+        preview_image, _ = run_and_measure_time(self._process_chain, {'image': input_image, 'generation': generation},
+                                                logger=self.logger)
+        if preview_image is None:
+            self.logger.debug(f"Preview cancelled.")
+            return
+        yield preview_image
+
+        if self._generation != generation:
+            return
+        completed, _ = run_and_measure_time(self._process, {}, logger=self.logger)
+        if not completed:
+            self.logger.debug(f"Render cancelled.")
+            return
+        yield self.output_image
+
+    def _process_chain(self, image: Image, generation: int):
+        for engine in self.engines.values():
+            engine.process(image)
+            if self._generation != generation:
+                return None
+        return image
+
+    def process_sequence(self, input_images, target_fps: float = None):
+        # Every frame goes through all engines. Selected engines write into buffers preallocated on the first frame,
+        # so a yielded image is valid only until the next one is requested.
+        selected_engines = self._get_selected_engines()
+        for engine in selected_engines:
+            engine.reuse_buffers = True
+        self._register_all_engines_for_update()
+        try:
+            for frame_index, input_image in enumerate(input_images):
+                self.input_image = input_image
+                _, elapsed_time = run_and_measure_time(self._process_frame, {'image': input_image}, logger=self.logger)
+                fps = 1.0 / elapsed_time if elapsed_time > 0 else float('inf')
+                if target_fps is not None and fps < target_fps:
+                    self.logger.warning(f"Frame {frame_index} processed at {fps:.2f} fps, target is {target_fps} fps.")
+                else:
+                    self.logger.debug(f"Frame {frame_index} processed at {fps:.2f} fps.")
+                yield self.output_image
+        finally:
+            for engine in selected_engines:
+                engine.reuse_buffers = False
+                engine._buffers.clear()
+            self._register_all_engines_for_update()
+
+    def process_region(self, roi, scale: float = 1.0):
+        # Renders only roi = (x, y, width, height) of the output image, resized by scale. The region is propagated
+        # backwards through the engines, so each one processes just what the following one needs. Branches and the
+        # cached full resolution images are left untouched.
+        region_image, _ = run_and_measure_time(self._process_region, {'roi': roi, 'scale': scale}, logger=self.logger)
+        return region_image
+
+    def supports_region(self):
+        # Engines depending on the whole image cannot render a region on their own.
+        return all(engine.supports_region() for engine in self.engines.values() if hasattr(engine, 'supports_region'))
+
+    def _process_region(self, roi, scale: float):
+        engines = list(self.engines.values())
+        shapes = self._get_shapes()
+
+        x, y, width, height = roi
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, shapes[-1][1]), min(y + height, shapes[-1][0])
+        if x1 <= x0 or y1 <= y0:
+            self.logger.error(f"Region {roi} is outside of the output image of shape {shapes[-1]}.")
+            raise ValueError
+
+        # Engines without region methods work pixel by pixel and need the same region as they output.
+        rois = [(x0, y0, x1 - x0, y1 - y0)]
+        for engine, shape in zip(reversed(engines), reversed(shapes[:-1])):
+            rois.insert(0, engine.get_input_roi(rois[0], shape) if hasattr(engine, 'get_input_roi') else rois[0])
+
+        region_image = copy(self.input_image)
+        region_image.camera_white_balance = deepcopy(self.input_image.camera_white_balance)
+        region_image.raw_image = self._crop(self.input_image.raw_image, rois[0], (0, 0, shapes[0][1], shapes[0][0]))
+        processed_roi = rois[0]
+        for engine_name, engine, shape, next_roi in zip(self.engines.keys(), engines, shapes, rois[1:]):
+            if hasattr(engine, 'process_region'):
+                # Engines calibrated per pixel of the image need to know where the region is.
+                engine.process_region(region_image, processed_roi, shape)
+            elif hasattr(engine, 'needs_statistics') and engine.needs_statistics():
+                engine.process(region_image, statistics_image=self._get_statistics_image(engine_name))
+            else:
+                engine.process(region_image)
+            if hasattr(engine, 'get_output_roi'):
+                processed_roi = engine.get_output_roi(processed_roi, shape)
+            region_image.raw_image = self._crop(region_image.raw_image, next_roi, processed_roi)
+            processed_roi = next_roi
+        if np.may_share_memory(region_image.raw_image, self.input_image.raw_image):
+            region_image.raw_image = region_image.raw_image.copy()
+
+        if scale != 1.0:
+            out_width = max(int(round(region_image.raw_image.shape[1] * scale)), 1)
+            out_height = max(int(round(region_image.raw_image.shape[0] * scale)), 1)
+            interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR
+            region_image.raw_image = cv2.resize(np.ascontiguousarray(region_image.raw_image),
+                                                (out_width, out_height), interpolation=interpolation)
+        return region_image
+
+    def has_exact_statistics(self):
+        # Whether regions rendered now share the statistics of a full render, instead of the binned approximation.
+        return all(self._has_exact_statistics_image(engine_name) for engine_name, engine in self.engines.items()
+                   if hasattr(engine, 'needs_statistics') and engine.needs_statistics())
+
+    def _has_exact_statistics_image(self, engine_name):
+        engine_names = list(self.engines.keys())
+        engine_index = engine_names.index(engine_name)
+        engines_to_update = self.get_engines_to_update()
+        first_index_to_update = engine_names.index(engines_to_update[0]) if engines_to_update else len(engine_names)
+        return engine_index == 0 or (engine_name in self.inputs and engine_index <= first_index_to_update)
+
+    def _get_statistics_image(self, engine_name, binning: int = 4):
+        # Whole image input of an engine whose statistics a region must share. The input kept from the last render is
+        # exact while no engine before it changed, otherwise the engines before it are run once on the binned mosaic.
+        engine_index = list(self.engines.keys()).index(engine_name)
+        if engine_index == 0:
+            return self.input_image
+        if self._has_exact_statistics_image(engine_name):
+            return self.inputs[engine_name]
+
+        key = (self._generation, id(self.input_image))
+        if engine_name not in self._statistics_images or self._statistics_images[engine_name][0] != key:
+            statistics_image = copy(self.input_image)
+            statistics_image.camera_white_balance = deepcopy(self.input_image.camera_white_balance)
+            statistics_image.raw_image = bin_bayer(self.input_image.raw_image, binning)
+            for engine in list(self.engines.values())[:engine_index]:
+                engine.process(statistics_image)
+            self._statistics_images[engine_name] = (key, statistics_image)
+        return self._statistics_images[engine_name][1]
+
+    def get_output_shape(self):
+        return self._get_shapes()[-1]
+
+    def _get_shapes(self):
+        # Height and width of the image before each engine and of the output image.
+        shapes = [tuple(self.input_image.raw_image.shape[:2])]
+        for engine in self.engines.values():
+            shapes.append(tuple(engine.get_output_shape(shapes[-1])) if hasattr(engine, 'get_output_shape')
+                          else shapes[-1])
+        return shapes
+
+    @staticmethod
+    def _crop(raw_image, roi, image_roi):
+        # Crops roi out of raw_image which covers image_roi, both given in the same coordinates.
+        x, y, width, height = roi
+        x -= image_roi[0]
+        y -= image_roi[1]
+        return raw_image[y:y + height, x:x + width]
+
+    def _get_selected_engines(self):
+        selected_engines = [engine.engines.get(engine.engine) for engine in self.engines.values()
+                            if hasattr(engine, 'engines')]
+        selected_engines = [engine for engine in selected_engines if hasattr(engine, 'reuse_buffers')]
+        for branch in self.branches.values():
+            selected_engines += branch._get_selected_engines()
+        return selected_engines
+
+    def _register_all_engines_for_update(self):
+        self.inputs.clear()
+        for engine_name in self.engines.keys():
+            self.register_engine_for_update(engine_name)
+        for branch in self.branches.values():
+            branch._register_all_engines_for_update()
+
+    def _process_frame(self, image: Image):
+        # Engines replace raw_image instead of writing into it, only the metadata needs a private copy.
+        output_image = copy(image)
+        output_image.camera_white_balance = deepcopy(image.camera_white_balance)
+        for engine in self.engines.values():
+            engine.process(output_image)
+        self.output_image = output_image
+        for branch in self.branches.values():
+            branch.input_image = output_image
+            branch._process_frame(output_image)
+        return output_image
+
     def _process(self):
+        # Returns False if the render was superseded, the engines not processed yet stay registered for update.
+        generation = self._generation
         engines_to_update = self.get_engines_to_update()
-        if engines_to_update[0] not in self.inputs:
-            self.inputs[engines_to_update[0]] = self.input_image
-        for i in range(len(engines_to_update)):
-            output_image = deepcopy(self.inputs[engines_to_update[i]])
-            self.engines[engines_to_update[i]].process(output_image)
-            if i < len(engines_to_update) - 1:
-                self.inputs[engines_to_update[i + 1]] = output_image
-            else:
-                self.output_image = output_image
-            self.engines_update_state[engines_to_update[i]] = False
+        if not self.engines:
+            self.output_image = self.input_image
+        if engines_to_update:
+            if engines_to_update[0] not in self.inputs:
+                self.inputs[engines_to_update[0]] = self.input_image
+            for i in range(len(engines_to_update)):
+                output_image = deepcopy(self.inputs[engines_to_update[i]])
+                self.engines[engines_to_update[i]].process(output_image)
+                # Superseded while processing, the engine stays registered since its settings may have changed.
+                if self._generation != generation:
+                    return False
+                self.engines_update_state[engines_to_update[i]] = False
+                if i < len(engines_to_update) - 1:
+                    self.inputs[engines_to_update[i + 1]] = output_image
+                else:
+                    self.output_image = output_image
+
+        # Branches copy their input before the first engine, so they can share the output of this editor.
+        for branch in self.branches.values():
+            if branch.input_image is not self.output_image:
+                branch.input_image = self.output_image
+                branch.inputs.clear()
+                for engine_name in branch.engines.keys():
+                    branch.register_engine_for_update(engine_name)
+            if not branch._process():
+                return False
+        return True
 
     def get_engines_to_update(self):
         engines_to_update = []
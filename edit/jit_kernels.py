@@ -0,0 +1,126 @@
+import logging
+
+import numpy as np
+
+try:
+    import numba
+    JIT_AVAILABLE = True
+except ImportError:
+    numba = None
+    JIT_AVAILABLE = False
+
+logger = logging.getLogger(f"eremore.{__name__}")
+_warned_fallbacks = set()
+
+
+def warn_fallback(engine_class_name):
+    if engine_class_name not in _warned_fallbacks:
+        _warned_fallbacks.add(engine_class_name)
+        logger.warning(f"numba is not installed, {engine_class_name} falls back to NumPy.")
+
+
+if JIT_AVAILABLE:
+    @numba.njit(inline='always')
+    def _sample(raw_image, y, x):
+        if y < 0 or x < 0 or y >= raw_image.shape[0] or x >= raw_image.shape[1]:
+            return 0
+        return np.int64(raw_image[y, x])
+
+    @numba.njit(inline='always')
+    def _sample_green(raw_image, y, x, green_x_loc_0, green_x_loc_1):
+        green_x_loc = green_x_loc_0 if y % 2 == 0 else green_x_loc_1
+        if x % 2 != green_x_loc:
+            return 0
+        return _sample(raw_image, y, x)
+
+    @numba.njit(inline='always')
+    def _interpolate_red_blue(raw_image, y, x, color_loc_y, color_loc_x):
+        # Same neighbourhoods as the convolutions of DemosaicerLinear in full resolution coordinates.
+        same_row = (y - color_loc_y) % 2 == 0
+        same_column = (x - color_loc_x) % 2 == 0
+        if same_row and same_column:
+            return np.int64(raw_image[y, x])
+        y_1 = y + 2 * color_loc_y - 1
+        x_1 = x + 2 * color_loc_x - 1
+        if same_row:
+            return (_sample(raw_image, y, x_1) + _sample(raw_image, y, x_1 - 2)) >> 1
+        if same_column:
+            return (_sample(raw_image, y_1, x) + _sample(raw_image, y_1 - 2, x)) >> 1
+        return (_sample(raw_image, y_1, x_1) + _sample(raw_image, y_1 - 2, x_1) +
+                _sample(raw_image, y_1, x_1 - 2) + _sample(raw_image, y_1 - 2, x_1 - 2)) >> 2
+
+    @numba.njit(inline='always')
+    def _interpolate_green(raw_image, y, x, green_x_loc_0, green_x_loc_1):
+        green_x_loc = green_x_loc_0 if y % 2 == 0 else green_x_loc_1
+        if x % 2 == green_x_loc:
+            return np.int64(raw_image[y, x])
+        return (_sample_green(raw_image, y - 1, x, green_x_loc_0, green_x_loc_1) +
+                _sample_green(raw_image, y + 1, x, green_x_loc_0, green_x_loc_1) +
+                _sample_green(raw_image, y, x - 1, green_x_loc_0, green_x_loc_1) +
+                _sample_green(raw_image, y, x + 1, green_x_loc_0, green_x_loc_1)) >> 2
+
+    @numba.njit(parallel=True, cache=True)
+    def bayer_split(raw_image, out_raw_image, red_loc_y, red_loc_x, blue_loc_y, blue_loc_x,
+                    green_x_loc_0, green_x_loc_1):
+        height, width = raw_image.shape
+        for y in numba.prange(height):
+            green_x_loc = green_x_loc_0 if y % 2 == 0 else green_x_loc_1
+            for x in range(width):
+                out_raw_image[y, x, 0] = 0
+                out_raw_image[y, x, 1] = 0
+                out_raw_image[y, x, 2] = 0
+                if y % 2 == red_loc_y and x % 2 == red_loc_x:
+                    out_raw_image[y, x, 0] = raw_image[y, x]
+                elif y % 2 == blue_loc_y and x % 2 == blue_loc_x:
+                    out_raw_image[y, x, 2] = raw_image[y, x]
+                elif x % 2 == green_x_loc:
+                    out_raw_image[y, x, 1] = raw_image[y, x]
+
+    @numba.njit(parallel=True, cache=True)
+    def demosaice_linear(raw_image, out_raw_image, red_loc_y, red_loc_x, blue_loc_y, blue_loc_x,
+                         green_x_loc_0, green_x_loc_1):
+        height, width = raw_image.shape
+        for y in numba.prange(height):
+            for x in range(width):
+                out_raw_image[y, x, 0] = _interpolate_red_blue(raw_image, y, x, red_loc_y, red_loc_x)
+                out_raw_image[y, x, 1] = _interpolate_green(raw_image, y, x, green_x_loc_0, green_x_loc_1)
+                out_raw_image[y, x, 2] = _interpolate_red_blue(raw_image, y, x, blue_loc_y, blue_loc_x)
+
+    @numba.njit(parallel=True, cache=True)
+    def lut_gather(table, values, out_values):
+        last = table.shape[0] - 1
+        for i in numba.prange(values.shape[0]):
+            out_values[i] = table[min(values[i], last)]
+
+    @numba.njit(parallel=True, cache=True)
+    def lut_gather_rgb(tables, values, out_values):
+        last = tables.shape[1] - 1
+        for i in numba.prange(values.shape[0]):
+            for c in range(3):
+                out_values[i, c] = tables[c, min(values[i, c], last)]
+
+    @numba.njit(parallel=True, cache=True)
+    def lut_3d_trilinear(shaper_offsets, shaper_fractions, lut, lut_size, output_table, values, out_values):
+        last = shaper_fractions.shape[0] - 1
+        last_output = output_table.shape[0] - 1
+        for i in numba.prange(values.shape[0]):
+            r = min(values[i, 0], last)
+            g = min(values[i, 1], last)
+            b = min(values[i, 2], last)
+            base_index = shaper_offsets[0, r] + shaper_offsets[1, g] + shaper_offsets[2, b]
+            fraction_r = shaper_fractions[r]
+            fraction_g = shaper_fractions[g]
+            fraction_b = shaper_fractions[b]
+            for c in range(3):
+                value = np.float32(0.0)
+                for corner in range(8):
+                    corner_r = corner >> 2
+                    corner_g = (corner >> 1) & 1
+                    corner_b = corner & 1
+                    weight = ((fraction_r if corner_r else 1 - fraction_r) *
+                              (fraction_g if corner_g else 1 - fraction_g) *
+                              (fraction_b if corner_b else 1 - fraction_b))
+                    index = base_index + (corner_r * lut_size + corner_g) * lut_size + corner_b
+                    value += weight * lut[index, c]
+                output_index = min(max(np.int64(value + 0.5), 0), last_output)
+                out_values[i, c] = output_table[output_index]
@@ -0,0 +1,221 @@
+import os
+import json
+import math
+import shutil
+import logging
+import weakref
+import tempfile
+
+import numpy as np
+import cv2
+
+from collections import OrderedDict
+
+from helper.get_attributes import get_attributes
+from helper.get_fingerprint import get_fingerprint
+from helper.run_and_measure_time import run_and_measure_time
+
+from edit.editor import Editor
+
+
+class PyramidCache:
+    # Tiles of the output of an editor at halving resolutions, level 0 is the full resolution. Tiles are stored as .npy
+    # files next to a manifest holding the fingerprints of the input image and of every engine they were rendered with.
+    # Tiles rendered as regions before the whole image statistics of an engine are known use binned statistics, the
+    # manifest lists them so they are rendered again once the exact statistics exist.
+    manifest_name = 'manifest.json'
+
+    def __init__(self, editor: Editor, directory: str = None, tile_size: int = 256, source: str = None,
+                 name: str = 'pyramid_cache'):
+        self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
+        self.name = name
+        self.editor = editor
+        self.directory = directory if directory is not None else tempfile.mkdtemp(prefix='eremore_pyramid_')
+        # A temporary directory belongs to the cache and is removed with it.
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.directory, ignore_errors=True) \
+            if directory is None else None
+        self.tile_size = tile_size
+        self.source = source
+        self._levels = {}
+        self._input_fingerprint = None
+        os.makedirs(self.directory, exist_ok=True)
+        self.manifest = self._load_manifest()
+
+    def get_tile(self, level: int, x: int, y: int):
+        self.validate()
+        level_height, level_width = self.get_level_shape(level)
+        if not 0 <= level < self.get_number_of_levels() or \
+                not 0 <= x * self.tile_size < level_width or not 0 <= y * self.tile_size < level_height:
+            self.logger.error(f"Tile {(level, x, y)} is outside of the pyramid.")
+            raise ValueError
+
+        path_to_tile = self._get_path_to_tile(level, x, y)
+        if os.path.exists(path_to_tile) and \
+                not (self._is_approximate_tile(level, x, y) and self.editor.has_exact_statistics()):
+            return np.load(path_to_tile)
+        tile, _ = run_and_measure_time(self._render_tile, {'level': level, 'x': x, 'y': y}, logger=self.logger)
+        self._save_tile(path_to_tile, tile)
+        self._set_approximate_tile(level, x, y, not self.editor.has_exact_statistics())
+        return tile
+
+    def build(self):
+        # Renders the full image once and cuts every tile of every level out of it.
+        self.validate()
+        self.editor.process()
+        for level in range(self.get_number_of_levels()):
+            level_height, level_width = self.get_level_shape(level)
+            for y in range(math.ceil(level_height / self.tile_size)):
+                for x in range(math.ceil(level_width / self.tile_size)):
+                    path_to_tile = self._get_path_to_tile(level, x, y)
+                    if not os.path.exists(path_to_tile) or self._is_approximate_tile(level, x, y):
+                        self._save_tile(path_to_tile, self._render_tile(level, x, y))
+        if self.manifest.pop('approximate_tiles', None):
+            self._save_manifest()
+
+    def close(self):
+        # Removes the directory if the cache created it, a directory given by the caller is kept.
+        self._levels.clear()
+        if self._finalizer is not None:
+            self._finalizer()
+
+    def validate(self):
+        # Compares the fingerprints with the ones the tiles were rendered with. Tiles are dropped when anything
+        # changed and the changed engines are registered for update, so the editor re-runs only from the first one.
+        # Without a manifest nothing is known about the tiles on disk, but the editor may well be up to date.
+        fingerprints = self._get_fingerprints()
+        cached_fingerprints = self.manifest.get('fingerprints')
+        if fingerprints == cached_fingerprints:
+            return
+        if cached_fingerprints is not None:
+            changed_stages = [stage for stage, fingerprint in fingerprints.items()
+                              if cached_fingerprints.get(stage) != fingerprint]
+            self.logger.debug(f"Invalidating cached tiles, changed stages: {changed_stages}")
+            for stage in changed_stages:
+                if stage in self.editor.engines:
+                    self.editor.register_engine_for_update(stage)
+                elif self.editor.engines:
+                    self.editor.register_engine_for_update(next(iter(self.editor.engines)))
+        self.invalidate()
+        self.manifest = {'tile_size': self.tile_size,
+                         'shape': list(self.editor.get_output_shape()),
+                         'fingerprints': fingerprints}
+        self._save_manifest()
+
+    def invalidate(self):
+        self._levels.clear()
+        if self.manifest.pop('approximate_tiles', None):
+            self._save_manifest()
+        for entry in os.listdir(self.directory):
+            if entry.isdigit():
+                shutil.rmtree(os.path.join(self.directory, entry), ignore_errors=True)
+
+    def get_number_of_levels(self):
+        height, width = self.editor.get_output_shape()
+        return max(math.ceil(math.log2(max(height, width) / self.tile_size)), 0) + 1
+
+    def get_level_shape(self, level: int):
+        height, width = self.editor.get_output_shape()
+        return math.ceil(height / 2**level), math.ceil(width / 2**level)
+
+    def _render_tile(self, level: int, x: int, y: int):
+        level_height, level_width = self.get_level_shape(level)
+        x0, y0 = x * self.tile_size, y * self.tile_size
+        x1, y1 = min(x0 + self.tile_size, level_width), min(y0 + self.tile_size, level_height)
+
+        # Cut from the full render if it is up to date or if the editor cannot render regions, otherwise render just
+        # the region covered by the tile.
+        if self.editor.output_image is None or self.editor.get_engines_to_update():
+            if self.editor.supports_region():
+                return self._render_region_tile(level, x0, y0, x1, y1)
+            self.logger.debug(f"Editor does not support region rendering, rendering the full image.")
+            self.editor.process()
+            self._levels.clear()
+        return np.array(self._get_level(level)[y0:y1, x0:x1])
+
+    def _render_region_tile(self, level: int, x0: int, y0: int, x1: int, y1: int):
+        height, width = self.editor.get_output_shape()
+        roi_x0, roi_y0 = x0 * 2**level, y0 * 2**level
+        roi_x1, roi_y1 = min(x1 * 2**level, width), min(y1 * 2**level, height)
+        tile = self.editor.process_region((roi_x0, roi_y0, roi_x1 - roi_x0, roi_y1 - roi_y0)).raw_image
+        # The region starts on a block of every level above, halving it gives the pixels of the full level.
+        for _ in range(level):
+            tile = self._halve(tile)
+        return tile
+
+    def _get_level(self, level: int):
+        if level == 0:
+            return self.editor.output_image.raw_image
+        if level not in self._levels:
+            self._levels[level] = self._halve(self._get_level(level - 1))
+        return self._levels[level]
+
+    @staticmethod
+    def _halve(raw_image):
+        # Averages blocks of 2x2 pixels, an odd last row or column is averaged with itself. Each block depends on its
+        # own pixels only, so halving a block aligned region matches the same part of the halved image.
+        pad = ((0, raw_image.shape[0] % 2), (0, raw_image.shape[1] % 2)) + ((0, 0),) * (raw_image.ndim - 2)
+        raw_image = np.pad(raw_image, pad, mode='edge') if any(pad[0] + pad[1]) else raw_image
+        return cv2.resize(np.ascontiguousarray(raw_image), (raw_image.shape[1] // 2, raw_image.shape[0] // 2),
+                          interpolation=cv2.INTER_AREA)
+
+    def _get_fingerprints(self):
+        fingerprints = OrderedDict()
+        fingerprints['input'] = self._get_input_fingerprint()
+        for engine_name, engine in self.editor.engines.items():
+            selected_engine = engine.engines.get(engine.engine) if hasattr(engine, 'engines') else None
+            fingerprints[engine_name] = get_fingerprint({
+                'engine': getattr(engine, 'engine', None),
+                'attributes': get_attributes(selected_engine) if selected_engine is not None else None})
+        return dict(fingerprints)
+
+    def _get_input_fingerprint(self):
+        if self.source is not None:
+            return get_fingerprint(self.source)
+        # Hashing the raw image is done once per input image.
+        input_image = self.editor.input_image
+        if self._input_fingerprint is None or self._input_fingerprint[0] is not input_image:
+            self._input_fingerprint = (input_image, get_fingerprint(input_image.raw_image))
+        return self._input_fingerprint[1]
+
+    def _is_approximate_tile(self, level: int, x: int, y: int):
+        return f"{level}/{y}_{x}" in self.manifest.get('approximate_tiles', [])
+
+    def _set_approximate_tile(self, level: int, x: int, y: int, approximate: bool):
+        if approximate == self._is_approximate_tile(level, x, y):
+            return
+        approximate_tiles = set(self.manifest.get('approximate_tiles', []))
+        if approximate:
+            approximate_tiles.add(f"{level}/{y}_{x}")
+        else:
+            approximate_tiles.discard(f"{level}/{y}_{x}")
+        self.manifest['approximate_tiles'] = sorted(approximate_tiles)
+        self._save_manifest()
+
+    def _get_path_to_tile(self, level: int, x: int, y: int):
+        return os.path.join(self.directory, str(level), f"{y}_{x}.npy")
+
+    @staticmethod
+    def _save_tile(path_to_tile, tile):
+        # Written to a temporary file first, a reader never sees a partially written tile.
+        os.makedirs(os.path.dirname(path_to_tile), exist_ok=True)
+        path_to_temporary_tile = f"{path_to_tile}.{os.getpid()}.tmp"
+        with open(path_to_temporary_tile, 'wb') as file:
+            np.save(file, tile)
+        os.replace(path_to_temporary_tile, path_to_tile)
+
+    def _load_manifest(self):
+        path_to_manifest = os.path.join(self.directory, self.manifest_name)
+        if not os.path.exists(path_to_manifest):
+            return {}
+        with open(path_to_manifest) as file:
+            manifest = json.load(file)
+        if manifest.get('tile_size') != self.tile_size:
+            self.logger.debug(f"Cached tiles have size {manifest.get('tile_size')}, dropping them.")
+            return {}
+        return manifest
+
+    def _save_manifest(self):
+        path_to_manifest = os.path.join(self.directory, self.manifest_name)
+        with open(f"{path_to_manifest}.tmp", 'w') as file:
+            json.dump(self.manifest, file, indent=2)
+        os.replace(f"{path_to_manifest}.tmp", path_to_manifest)
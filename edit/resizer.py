@@ -0,0 +1,106 @@
+from abc import ABC, abstractmethod
+
+import logging
+
+import numpy as np
+import cv2
+
+from collections import OrderedDict
+
+from helper.get_attributes import get_attributes
+from helper.run_and_measure_time import run_and_measure_time
+
+from core.image import Image
+
+
+class Resizer:
+    def __init__(self, name: str = 'resizer', engine: str = None):
+        self.logger = logging.getLogger(f"eremore.{__name__}")
+        self.name = name
+        self.engine = engine
+        self.engines = OrderedDict()
+        self.engines['open_cv'] = ResizerOpenCV()
+
+    def process(self, image: Image):
+        if self.engine is None:
+            return
+        if self.engine not in self.engines.keys():
+            self.logger.error(f"Resizer engine {self.engine} does not exists.")
+            raise ValueError
+
+        self.engines[self.engine].resize(image)
+
+    def get_output_shape(self, shape):
+        if self.engine is None:
+            return shape
+        return self.engines[self.engine].get_output_size(*shape)
+
+    def supports_region(self):
+        # The scale depends on the size of the whole image, a crop would be resized differently.
+        return self.engine is None
+
+    def get_input_roi(self, roi, shape):
+        if self.supports_region():
+            return roi
+        self.logger.error(f"Resizer does not support region rendering, use the scale of Editor.process_region.")
+        raise ValueError
+
+
+class ResizerBase(ABC):
+    def __init__(self, scale: float = None, max_size: int = None):
+        self.logger = logging.getLogger(f"eremore.{__name__}")
+        self.name = None
+        self.scale = scale
+        self.max_size = max_size
+
+    def resize(self, image: Image):
+        attributes = get_attributes(self)
+        arguments = {'image': image}
+        self.logger.debug(f"Resizing with -> attributes: {attributes} | arguments: {arguments}")
+        run_and_measure_time(self._resize_wrapper, arguments, logger=self.logger)
+
+    def _resize_wrapper(self, image: Image):
+        height, width = image.raw_image.shape[:2]
+        out_height, out_width = self.get_output_size(height, width)
+        if (out_height, out_width) == (height, width):
+            return
+        self._resize(image, out_height, out_width)
+
+    def get_output_size(self, height, width):
+        scale = self.get_scale(height, width)
+        return max(int(round(height * scale)), 1), max(int(round(width * scale)), 1)
+
+    def get_scale(self, height, width):
+        scale = 1.0 if self.scale is None else self.scale
+        if self.max_size is not None and max(height, width) * scale > self.max_size:
+            scale = self.max_size / max(height, width)
+        return scale
+
+    @abstractmethod
+    def _resize(self, image: Image, out_height: int, out_width: int):
+        pass
+
+    def set(self, name=None, scale=None, max_size=None):
+        self._set(name, scale, max_size)
+
+    def _set(self, name=None, scale=None, max_size=None):
+        if name is not None:
+            self.name = name
+            self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
+        if scale is not None:
+            self.scale = scale
+        if max_size is not None:
+            self.max_size = max_size
+
+
+class ResizerOpenCV(ResizerBase):
+    def __init__(self, name='open_cv'):
+        super().__init__()
+        self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
+        self.name = name
+
+    def _resize(self, image: Image, out_height: int, out_width: int):
+        height, width = image.raw_image.shape[:2]
+        interpolation = cv2.INTER_AREA if out_height * out_width < height * width else cv2.INTER_LINEAR
+        image.raw_image = cv2.resize(np.ascontiguousarray(image.raw_image), (out_width, out_height),
+                                     interpolation=interpolation)
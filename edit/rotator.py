@@ -29,6 +29,21 @@ class Rotator:
 
         self.engines[self.engine].rotate(image)
 
+    def get_output_shape(self, shape):
+        if self.engine is None:
+            return shape
+        return self.engines[self.engine].get_output_shape(shape)
+
+    def get_input_roi(self, roi, shape):
+        if self.engine is None:
+            return roi
+        return self.engines[self.engine].get_input_roi(roi, shape)
+
+    def get_output_roi(self, roi, shape):
+        if self.engine is None:
+            return roi
+        return self.engines[self.engine].get_output_roi(roi, shape)
+
 
 class RotatorBase(ABC):
     def __init__(self):
@@ -45,6 +60,18 @@ class RotatorBase(ABC):
     def _rotate(self, image: Image):
         pass
 
+    @abstractmethod
+    def get_output_shape(self, shape):
+        pass
+
+    @abstractmethod
+    def get_input_roi(self, roi, shape):
+        pass
+
+    @abstractmethod
+    def get_output_roi(self, roi, shape):
+        pass
+
     def set(self, name=None):
         self._set(name)
 
@@ -64,6 +91,29 @@ class Rotator90(RotatorBase):
     def _rotate(self, image: Image):
         image.raw_image = np.rot90(image.raw_image, self.k)
 
+    def get_output_shape(self, shape):
+        return self._rotate_shape(shape, self.k)
+
+    def get_input_roi(self, roi, shape):
+        return self._rotate_roi(roi, self.get_output_shape(shape), -self.k)
+
+    def get_output_roi(self, roi, shape):
+        return self._rotate_roi(roi, shape, self.k)
+
+    @staticmethod
+    def _rotate_shape(shape, k):
+        return (shape[1], shape[0]) if k % 2 else tuple(shape)
+
+    @staticmethod
+    def _rotate_roi(roi, shape, k):
+        # np.rot90 moves the pixel (row, column) of a height x width image to (width - 1 - column, row).
+        x, y, width, height = roi
+        image_height, image_width = shape
+        for _ in range(k % 4):
+            x, y, width, height = y, image_width - x - width, height, width
+            image_height, image_width = image_width, image_height
+        return x, y, width, height
+
     def set(self, name=None, k=None):
         super()._set(name)
         if k is not None:
@@ -0,0 +1,383 @@
+import os
+from abc import ABC, abstractmethod
+
+import logging
+
+import numpy as np
+import cv2
+
+from collections import OrderedDict
+
+from helper.bin_bayer import bin_bayer
+from helper.get_attributes import get_attributes
+from helper.run_and_measure_time import run_and_measure_time
+from helper.get_buffer import get_buffer
+
+from core.image import Image
+
+
+class SensorCorrector:
+    def __init__(self, name: str = 'sensor_corrector', engine: str = None):
+        self.logger = logging.getLogger(f"eremore.{__name__}")
+        self.name = name
+        self.engine = engine
+        self.engines = OrderedDict()
+        self.engines['dark_frame'] = SensorCorrectorDarkFrame()
+        self.engines['flat_field'] = SensorCorrectorFlatField()
+        self.engines['bad_pixel'] = SensorCorrectorBadPixel()
+
+    def process(self, image: Image):
+        if self.engine is None:
+            return
+        if self.engine not in self.engines.keys():
+            self.logger.error(f"SensorCorrector engine {self.engine} does not exists.")
+            raise ValueError
+
+        self.engines[self.engine].correct(image)
+
+    def process_region(self, image: Image, roi, shape):
+        # image holds roi = (x, y, width, height) of an image of shape, the calibration is cropped to it.
+        if self.engine is None:
+            return
+        if self.engine not in self.engines.keys():
+            self.logger.error(f"SensorCorrector engine {self.engine} does not exists.")
+            raise ValueError
+
+        self.engines[self.engine].correct(image, roi, shape)
+
+    def get_input_roi(self, roi, shape):
+        if self.engine is None:
+            return roi
+        return self.engines[self.engine].get_input_roi(roi, shape)
+
+
+class SensorCorrectorBase(ABC):
+    # Calibrations are shared by all instances and loaded once per camera, calibration_directory holds a directory
+    # per camera id with the calibration files. They are kept at the sensor resolution and cropped or binned to the
+    # regions and previews rendered from it.
+    _calibration_cache = OrderedDict()
+    _calibration_cache_size = 4
+    # Rows of the raw image processed at once, bounds the temporary arrays.
+    _chunk_size = 256
+    calibration_file_name = None
+
+    def __init__(self,
+                 calibration_directory: str = None, camera_id: str = None,
+                 input_black_level: int = 0, input_white_level: int = 2**14-1):
+        self.logger = logging.getLogger(f"eremore.{__name__}")
+        self.name = None
+        self.calibration_directory = calibration_directory
+        # Overrides the camera id of the image.
+        self.camera_id = camera_id
+        self.input_black_level = input_black_level
+        self.input_white_level = input_white_level
+        self.reuse_buffers = False
+        self._buffers = {}
+
+    def correct(self, image: Image, roi=None, shape=None):
+        attributes = get_attributes(self)
+        arguments = {'image': image, 'roi': roi, 'shape': shape}
+        self.logger.debug(f"Correcting with -> attributes: {attributes} | arguments: {arguments}")
+        run_and_measure_time(self._correct_wrapper, arguments, logger=self.logger)
+
+    def _correct_wrapper(self, image: Image, roi=None, shape=None):
+        camera_id = self.camera_id if self.camera_id is not None else image.camera_id
+        if self.calibration_directory is None or camera_id is None:
+            self.logger.warning(f"calibration_directory or camera id not set, doing nothing.")
+            return
+        key = (type(self).__name__, self.calibration_directory, camera_id, self._get_calibration_parameters())
+        calibration = self._get_cached(key, lambda: self._load_calibration(camera_id))
+        if calibration is None:
+            return
+        sensor_shape = calibration[0]
+
+        # The whole image, a region of it or a preview binned from it.
+        raw_shape = tuple(image.raw_image.shape)
+        if sensor_shape is None:
+            # A calibration without a shape, such as a list of pixels, is taken to cover the full image.
+            sensor_shape = tuple(shape) if roi is not None else raw_shape
+        binning = 1
+        if roi is None:
+            roi = (0, 0, raw_shape[1], raw_shape[0]) if len(raw_shape) == 2 else None
+            shape = raw_shape
+            if raw_shape != sensor_shape:
+                binning = self._get_binning(raw_shape, sensor_shape)
+        if roi is None or binning is None or (binning == 1 and tuple(shape) != sensor_shape):
+            self.logger.warning(f"Calibration of shape {sensor_shape} does not match the raw image of shape "
+                                f"{raw_shape}, doing nothing.")
+            return
+        # The input may be shared with the caller, engines always write into a new array.
+        image.raw_image = self._correct(image.raw_image, calibration[1], key, roi[:2], binning, sensor_shape)
+
+    @abstractmethod
+    def _correct(self, raw_image, calibration, key, offset, binning, sensor_shape):
+        pass
+
+    def get_input_roi(self, roi, shape):
+        return roi
+
+    def _get_cached(self, key, load):
+        # Misses are not cached, a calibration copied in later is picked up.
+        if key in self._calibration_cache:
+            self._calibration_cache.move_to_end(key)
+            return self._calibration_cache[key]
+        value = load()
+        if value is None:
+            return None
+        self._calibration_cache[key] = value
+        if len(self._calibration_cache) > self._calibration_cache_size:
+            self._calibration_cache.popitem(last=False)
+        return value
+
+    def _load_calibration(self, camera_id):
+        path_to_calibration = os.path.join(self.calibration_directory, camera_id, self.calibration_file_name)
+        if not os.path.exists(path_to_calibration):
+            self.logger.warning(f"No calibration {path_to_calibration}, doing nothing.")
+            return None
+        calibration = np.load(path_to_calibration)
+        self.logger.debug(f"Loaded calibration {path_to_calibration}")
+        return self._get_sensor_shape(calibration), self._prepare_calibration(calibration)
+
+    def _get_sensor_shape(self, calibration):
+        return tuple(calibration.shape)
+
+    @staticmethod
+    def _get_binning(shape, sensor_shape):
+        # Binning of helper.bin_bayer turning a mosaic of sensor_shape into one of shape, None if there is none.
+        if len(shape) != 2 or shape[0] == 0:
+            return None
+        binning = max(sensor_shape[0] // shape[0], 1)
+        for candidate in (binning, binning + 1):
+            cell = 2 * candidate
+            if candidate > 1 and (sensor_shape[0] // cell * 2, sensor_shape[1] // cell * 2) == shape:
+                return candidate
+        return None
+
+    def _get_calibration_parameters(self):
+        return self.input_black_level, self.input_white_level
+
+    def _get_out_raw_image(self, raw_image):
+        if self.reuse_buffers:
+            return get_buffer(self._buffers, 'out', raw_image.shape, np.uint16)
+        return np.empty(raw_image.shape, dtype=np.uint16)
+
+    @abstractmethod
+    def _prepare_calibration(self, calibration):
+        pass
+
+    def set(self,
+            name=None,
+            calibration_directory=None, camera_id=None,
+            input_black_level=None, input_white_level=None):
+        self._set(name,
+                  calibration_directory, camera_id,
+                  input_black_level, input_white_level)
+
+    def _set(self,
+             name=None,
+             calibration_directory=None, camera_id=None,
+             input_black_level=None, input_white_level=None):
+        if name is not None:
+            self.name = name
+            self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
+        if calibration_directory is not None:
+            self.calibration_directory = calibration_directory
+        if camera_id is not None:
+            self.camera_id = camera_id
+        if input_black_level is not None:
+            self.input_black_level = input_black_level
+        if input_white_level is not None:
+            self.input_white_level = input_white_level
+
+
+class SensorCorrectorDarkFrame(SensorCorrectorBase):
+    # dark_frame.npy is a raw image taken with the lens cap on, black level included.
+    calibration_file_name = 'dark_frame.npy'
+
+    def __init__(self, name='dark_frame'):
+        super().__init__()
+        self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
+        self.name = name
+
+    def _prepare_calibration(self, calibration):
+        # Kept as the offset above the black level, which stays in the image for the following engines.
+        offset = np.subtract(calibration, self.input_black_level, dtype=np.int32)
+        np.clip(offset, np.iinfo(np.int16).min, np.iinfo(np.int16).max, out=offset)
+        return offset.astype(dtype=np.int16)
+
+    def _correct(self, raw_image, calibration, key, offset, binning, sensor_shape):
+        if binning > 1:
+            calibration = self._get_cached(key + (binning,), lambda: bin_bayer(calibration, binning))
+        x, y = offset
+        calibration = calibration[y:y + raw_image.shape[0], x:x + raw_image.shape[1]]
+        out_raw_image = self._get_out_raw_image(raw_image)
+        for start in range(0, raw_image.shape[0], self._chunk_size):
+            end = start + self._chunk_size
+            difference = np.subtract(raw_image[start:end], calibration[start:end], dtype=np.int32)
+            np.clip(difference, 0, self.input_white_level, out=difference)
+            out_raw_image[start:end] = difference
+        return out_raw_image
+
+
+class SensorCorrectorFlatField(SensorCorrectorBase):
+    # flat_field.npy holds the gain of every raw pixel, the inverse of the lens shading normalized to the center.
+    calibration_file_name = 'flat_field.npy'
+
+    def __init__(self, name='flat_field', downscale: int = 16):
+        super().__init__()
+        self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
+        self.name = name
+        self.downscale = downscale
+
+    def _get_calibration_parameters(self):
+        return super()._get_calibration_parameters() + (self.downscale,)
+
+    def _prepare_calibration(self, calibration):
+        # Shading is smooth, the gains of each Bayer phase are kept as a float16 map downscaled by downscale and
+        # interpolated back while applying them.
+        gain_maps = []
+        for i in range(2):
+            for j in range(2):
+                phase = np.ascontiguousarray(calibration[i::2, j::2], dtype=np.float32)
+                reduced_shape = (max(phase.shape[1] // self.downscale, 1), max(phase.shape[0] // self.downscale, 1))
+                gain_maps.append(cv2.resize(phase, reduced_shape, interpolation=cv2.INTER_AREA).astype(np.float16))
+        return gain_maps
+
+    def _correct(self, raw_image, calibration, key, offset, binning, sensor_shape):
+        out_raw_image = self._get_out_raw_image(raw_image)
+        x, y = offset
+        for i in range(2):
+            for j in range(2):
+                raw_phase = raw_image[i::2, j::2]
+                out_phase = out_raw_image[i::2, j::2]
+                # Phase of the sensor the pixels of this phase of the region come from, and their first index in it.
+                sensor_i, sensor_j = (y + i) % 2, (x + j) % 2
+                gain_map = calibration[2 * sensor_i + sensor_j].astype(np.float32)
+                sensor_phase_shape = (len(range(sensor_i, sensor_shape[0], 2)), len(range(sensor_j, sensor_shape[1], 2)))
+                # Bilinear upsampling split in two passes: the columns of the small map are interpolated at the
+                # columns of the region once, the rows of each chunk between two of the resulting rows.
+                top, bottom, row_fractions = self._get_positions(raw_phase.shape[0], (y + i) // 2, binning,
+                                                                 sensor_phase_shape[0], gain_map.shape[0])
+                left, right, column_fractions = self._get_positions(raw_phase.shape[1], (x + j) // 2, binning,
+                                                                    sensor_phase_shape[1], gain_map.shape[1])
+                gain_rows = gain_map[:, left]
+                gain_rows += (gain_map[:, right] - gain_rows) * column_fractions
+                row_fractions = np.expand_dims(row_fractions, axis=1)
+                for start in range(0, raw_phase.shape[0], self._chunk_size):
+                    end = start + self._chunk_size
+                    gains = gain_rows[top[start:end]]
+                    gains += (gain_rows[bottom[start:end]] - gains) * row_fractions[start:end]
+                    values = raw_phase[start:end].astype(dtype=np.float32)
+                    values -= self.input_black_level
+                    values *= gains
+                    values += self.input_black_level + 0.5
+                    np.clip(values, 0, self.input_white_level, out=values)
+                    out_phase[start:end] = values
+        return out_raw_image
+
+    @staticmethod
+    def _get_positions(length, start, binning, sensor_length, map_length):
+        # Neighbouring map entries and weights of length pixels of a phase starting at the phase pixel start of the
+        # sensor, a binned pixel being at the center of the ones it averages.
+        sensor_positions = start + (np.arange(length, dtype=np.float64) + 0.5) * binning - 0.5
+        positions = (sensor_positions + 0.5) * (map_length / sensor_length) - 0.5
+        positions = np.clip(positions, 0, map_length - 1)
+        lower = positions.astype(dtype=np.intp)
+        upper = np.minimum(lower + 1, map_length - 1)
+        return lower, upper, (positions - lower).astype(np.float32)
+
+    def set(self,
+            name=None,
+            calibration_directory=None, camera_id=None,
+            input_black_level=None, input_white_level=None,
+            downscale=None):
+        super()._set(name,
+                     calibration_directory, camera_id,
+                     input_black_level, input_white_level)
+        if downscale is not None:
+            self.downscale = downscale
+
+
+class SensorCorrectorBadPixel(SensorCorrectorBase):
+    # bad_pixels.npy lists the hot, dead and stuck pixels as an integer array of (row, column) pairs, or marks them in a
+    # map of the sensor. A list has no sensor shape, it is applied to the full image it is given with and an image
+    # smaller than the listed pixels reach, such as a binned preview, is left alone.
+    calibration_file_name = 'bad_pixels.npy'
+    # Distance of the neighbours of the same color a bad pixel is interpolated from.
+    halo = 2
+
+    def __init__(self, name='bad_pixel'):
+        super().__init__()
+        self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
+        self.name = name
+
+    def get_input_roi(self, roi, shape):
+        # Grown by the neighbours, which keeps the Bayer phase of the region.
+        x, y, width, height = roi
+        x0, y0 = max(x - self.halo, 0), max(y - self.halo, 0)
+        x1, y1 = min(x + width + self.halo, shape[1]), min(y + height + self.halo, shape[0])
+        return x0, y0, x1 - x0, y1 - y0
+
+    def _get_calibration_parameters(self):
+        return ()
+
+    @staticmethod
+    def _is_pixel_list(calibration):
+        return np.issubdtype(calibration.dtype, np.integer) and calibration.ndim == 2 and calibration.shape[1] == 2
+
+    def _get_sensor_shape(self, calibration):
+        return None if self._is_pixel_list(calibration) else tuple(calibration.shape)
+
+    def _prepare_calibration(self, calibration):
+        # Kept as the rows and columns of the bad pixels in raster order, so the flat indices of a region are sorted
+        # and checking the neighbours is a binary search.
+        if self._is_pixel_list(calibration):
+            return np.unique(calibration.astype(dtype=np.intp), axis=0).T.reshape(2, -1)
+        return np.stack(np.nonzero(calibration))
+
+    def _correct(self, raw_image, calibration, key, offset, binning, sensor_shape):
+        if binning > 1:
+            # A bad pixel is one of binning**2 averaged into a binned pixel.
+            self.logger.debug(f"Bad pixels are not corrected in images binned by {binning}.")
+            return raw_image
+        # The bad pixels inside the region, in its coordinates. Pixels within halo of the edge of a region are
+        # interpolated from mirrored neighbours, get_input_roi makes sure they are cropped away afterwards.
+        height, width = raw_image.shape
+        x, y = offset
+        rows, columns = calibration
+        if rows.size > 0 and (rows[-1] >= sensor_shape[0] or np.max(columns) >= sensor_shape[1]):
+            self.logger.debug(f"Bad pixels reach beyond the image of shape {sensor_shape}, taking it as a binned "
+                              f"preview and doing nothing.")
+            return raw_image
+        rows = rows - y
+        columns = columns - x
+        inside = (rows >= 0) & (rows < height) & (columns >= 0) & (columns < width)
+        bad_pixels = rows[inside] * width + columns[inside]
+        rows, columns = rows[inside], columns[inside]
+
+        # Every bad pixel gets the mean of the good pixels of the same color two pixels away in each direction.
+        out_raw_image = self._get_out_raw_image(raw_image)
+        np.copyto(out_raw_image, raw_image, casting='unsafe')
+        if bad_pixels.size == 0:
+            return out_raw_image
+        neighbours = []
+        for row_offset, column_offset in ((-2, 0), (2, 0), (0, -2), (0, 2)):
+            neighbour_rows = rows + row_offset
+            neighbour_columns = columns + column_offset
+            # Mirrored at the borders, the pixel on the other side has the same color.
+            neighbour_rows = np.where((neighbour_rows < 0) | (neighbour_rows >= height), rows - row_offset,
+                                      neighbour_rows)
+            neighbour_columns = np.where((neighbour_columns < 0) | (neighbour_columns >= width),
+                                         columns - column_offset, neighbour_columns)
+            neighbours.append(neighbour_rows * width + neighbour_columns)
+        neighbours = np.stack(neighbours)
+
+        positions = np.minimum(np.searchsorted(bad_pixels, neighbours), bad_pixels.size - 1)
+        good = bad_pixels[positions] != neighbours
+        values = out_raw_image.reshape(-1)[neighbours]
+        counts = np.sum(good, axis=0)
+        sums = np.sum(np.where(good, values, 0), axis=0, dtype=np.uint32)
+        corrected = counts > 0
+        out_raw_image.reshape(-1)[bad_pixels[corrected]] = (sums[corrected] + counts[corrected] // 2) // \
+            counts[corrected]
+        return out_raw_image
@@ -3,14 +3,18 @@ from abc import ABC, abstractmethod
 import logging
 
 import numpy as np
+import cv2
 
 from collections import OrderedDict
 
 from helper.get_attributes import get_attributes
 from helper.run_and_measure_time import run_and_measure_time
+from helper.get_buffer import get_buffer
 
 from core.image import Image
 
+from edit import jit_kernels
+
 
 class ToneMapper:
     def __init__(self, name: str = 'tone_mapper', engine: str = None):
@@ -20,6 +24,9 @@ class ToneMapper:
         self.engines = OrderedDict()
         self.engines['linear'] = ToneMapperLinear()
         self.engines['gamma_correction'] = ToneMapperGammaCorrection()
+        self.engines['local'] = ToneMapperLocal()
+        self.engines['linear_jit'] = ToneMapperLinearJIT()
+        self.engines['gamma_correction_jit'] = ToneMapperGammaCorrectionJIT()
 
     def process(self, image: Image):
         if self.engine is None:
@@ -30,13 +37,27 @@ class ToneMapper:
 
         self.engines[self.engine].tone_map(image)
 
+    def supports_region(self):
+        # The gains of local engines depend on the whole image, a crop would be tone mapped differently.
+        return self.engine is None or not self.engines[self.engine].local
+
+    def get_input_roi(self, roi, shape):
+        if self.supports_region():
+            return roi
+        self.logger.error(f"ToneMapper engine {self.engine} does not support region rendering.")
+        raise ValueError
+
 
 class ToneMapperBase(ABC):
+    # Engines mapping each pixel on its own, local engines also depend on the neighbourhood of the pixel.
+    local = False
+
     def __init__(self,
                  input_magnitude: int = 2**14,
                  input_black_level_correction: int = 512,
                  input_black_level: int = 0, input_white_level: int = 2**12-1,
-                 output_black_level: int = 0, output_white_level: int = 2**12-1):
+                 output_black_level: int = 0, output_white_level: int = 2**12-1,
+                 output_dtype: type = np.uint16):
         self.logger = logging.getLogger(f"eremore.{__name__}")
         self.name = None
         self.input_magnitude = input_magnitude
@@ -45,7 +66,10 @@ class ToneMapperBase(ABC):
         self.input_white_level = input_white_level
         self.output_black_level = output_black_level
         self.output_white_level = output_white_level
+        self.output_dtype = output_dtype
+        self.reuse_buffers = False
         self._tone_mapping_table = None
+        self._buffers = {}
 
     def tone_map(self, image: Image):
         attributes = get_attributes(self)
@@ -56,19 +80,31 @@ class ToneMapperBase(ABC):
     def _tone_map_wrapper(self, image: Image):
         if self._tone_mapping_table is None:
             self._update_tone_mapping_table()
-        image.raw_image = self._tone_mapping_table[image.raw_image]
+        image.raw_image = self._apply_tone_mapping_table(image.raw_image)
         self._tone_map_camera_white_balance(image)
 
+    def _apply_tone_mapping_table(self, raw_image):
+        if self.reuse_buffers:
+            out_raw_image = get_buffer(self._buffers, 'out', raw_image.shape, self._tone_mapping_table.dtype)
+            np.take(self._tone_mapping_table, raw_image, out=out_raw_image, mode='clip')
+            return out_raw_image
+        return self._tone_mapping_table[raw_image]
+
     @abstractmethod
     def _tone_map(self, tone_mapping_table):
         pass
 
     def _get_tone_mapping_table(self):
+        tone_mapping_table = self._get_float_tone_mapping_table()
+        output_dtype_info = np.iinfo(self.output_dtype)
+        tone_mapping_table = np.clip(tone_mapping_table, output_dtype_info.min, output_dtype_info.max)
+        return tone_mapping_table.astype(dtype=self.output_dtype)
+
+    def _get_float_tone_mapping_table(self):
         tone_mapping_table = np.asarray(range(0, self.input_magnitude), dtype=np.float32)
         tone_mapping_table -= self.input_black_level_correction
         tone_mapping_table = np.clip(tone_mapping_table, self.input_black_level, self.input_white_level)
-        tone_mapping_table = self._tone_map(tone_mapping_table)
-        return tone_mapping_table.astype(dtype=np.uint16)
+        return self._tone_map(tone_mapping_table)
 
     def _tone_map_camera_white_balance(self, image: Image):
         if image.camera_white_balance is None or len(image.camera_white_balance) != 3:
@@ -84,12 +120,14 @@ class ToneMapperBase(ABC):
             input_magnitude=None,
             input_black_level_correction=None,
             input_black_level=None, input_white_level=None,
-            output_black_level=None, output_white_level=None):
+            output_black_level=None, output_white_level=None,
+            output_dtype=None):
         self._set(name,
                   input_magnitude,
                   input_black_level_correction,
                   input_black_level, input_white_level,
-                  output_black_level, output_white_level)
+                  output_black_level, output_white_level,
+                  output_dtype)
         self._update_tone_mapping_table()
 
     def _set(self,
@@ -97,7 +135,8 @@ class ToneMapperBase(ABC):
              input_magnitude=None,
              input_black_level_correction=None,
              input_black_level=None, input_white_level=None,
-             output_black_level=None, output_white_level=None):
+             output_black_level=None, output_white_level=None,
+             output_dtype=None):
         if name is not None:
             self.name = name
             self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
@@ -113,6 +152,8 @@ class ToneMapperBase(ABC):
             self.output_black_level = output_black_level
         if output_white_level is not None:
             self.output_white_level = output_white_level
+        if output_dtype is not None:
+            self.output_dtype = output_dtype
 
 
 class ToneMapperLinear(ToneMapperBase):
@@ -151,15 +192,168 @@ class ToneMapperGammaCorrection(ToneMapperBase):
             input_black_level_correction=None,
             input_black_level=None, input_white_level=None,
             output_black_level=None, output_white_level=None,
+            output_dtype=None,
             gamma=None):
         super()._set(name,
                      input_magnitude,
                      input_black_level_correction,
                      input_black_level, input_white_level,
-                     output_black_level, output_white_level)
+                     output_black_level, output_white_level,
+                     output_dtype)
         if gamma is not None:
             self.gamma = gamma
         self._update_tone_mapping_table()
 
 
+class ToneMapperLocal(ToneMapperLinear):
+    # Maps the levels like ToneMapperLinear, then compresses the large scale contrast of the log luminance while
+    # keeping its details (Durand & Dorsey). The large scale is the log luminance smoothed by an edge preserving guided
+    # filter computed on a grid downscaled by downscale, its cost does not depend on the radius. Bayer mosaics get one
+    # gain per 2x2 cell so the colors are kept, RGB images one gain per pixel.
+    local = True
+    # Rows of the image processed at once, bounds the temporary arrays.
+    _chunk_size = 256
+
+    def __init__(self, name='local',
+                 compression: float = 0.5, detail: float = 1.0,
+                 radius: float = 0.02, epsilon: float = 0.1, downscale: int = 4):
+        super().__init__()
+        self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
+        self.name = name
+        # Factor of the large scale contrast in stops, 1 keeps it, and factor of the details.
+        self.compression = compression
+        self.detail = detail
+        # Radius of the filter relative to the longest side, so previews and exports match the full render.
+        self.radius = radius
+        # Variance of the log2 luminance below which the filter smooths, edges of about sqrt(epsilon) stops are kept.
+        self.epsilon = epsilon
+        self.downscale = downscale
+        self._float_tone_mapping_table = None
+
+    def _update_tone_mapping_table(self):
+        super()._update_tone_mapping_table()
+        # Gains are applied before rounding, uint8 outputs keep their shadows.
+        self._float_tone_mapping_table = self._get_float_tone_mapping_table()
+
+    def _apply_tone_mapping_table(self, raw_image):
+        cell = 2 if raw_image.ndim == 2 and min(raw_image.shape) >= 2 else 1
+        gains = self._get_gains(raw_image, cell)
+
+        height, width = raw_image.shape[:2]
+        output_dtype_info = np.iinfo(self.output_dtype)
+        if self.reuse_buffers:
+            out_raw_image = get_buffer(self._buffers, 'out', raw_image.shape, self._tone_mapping_table.dtype)
+        else:
+            out_raw_image = np.empty(raw_image.shape, dtype=self._tone_mapping_table.dtype)
+        for start in range(0, height, self._chunk_size):
+            end = min(start + self._chunk_size, height)
+            chunk_gains = gains[start // cell:(end + cell - 1) // cell]
+            if raw_image.ndim == 3:
+                chunk_gains = np.expand_dims(chunk_gains, axis=2)
+            elif cell > 1:
+                # The last row and column of odd sized mosaics use the gains of their neighbouring cells.
+                chunk_gains = np.repeat(np.repeat(chunk_gains, cell, axis=0)[:end - start], cell, axis=1)
+                chunk_gains = np.pad(chunk_gains, ((0, end - start - chunk_gains.shape[0]),
+                                                   (0, width - chunk_gains.shape[1])), mode='edge')
+            values = np.take(self._float_tone_mapping_table, raw_image[start:end], mode='clip')
+            values -= self.output_black_level
+            values *= chunk_gains
+            # Truncated like the table of ToneMapperLinear, a compression of 1 gives the same output.
+            values += self.output_black_level
+            np.clip(values, max(self.output_black_level, output_dtype_info.min),
+                    min(self.output_white_level, output_dtype_info.max), out=values)
+            out_raw_image[start:end] = values
+        return out_raw_image
+
+    def _get_gains(self, raw_image, cell):
+        # Luminance of each cell in output levels above the black level.
+        if raw_image.ndim == 3:
+            cells = cv2.transform(np.ascontiguousarray(raw_image), np.full((1, raw_image.shape[2]),
+                                                                           1 / raw_image.shape[2]))
+        elif cell > 1:
+            cells = raw_image[:raw_image.shape[0] // cell * cell, :raw_image.shape[1] // cell * cell]
+            cells = cv2.resize(np.ascontiguousarray(cells), (cells.shape[1] // cell, cells.shape[0] // cell),
+                               interpolation=cv2.INTER_AREA)
+        else:
+            cells = raw_image
+        luminance = np.take(self._float_tone_mapping_table, cells, mode='clip')
+        luminance -= self.output_black_level - 1
+        np.maximum(luminance, 1, out=luminance)
+        log_luminance = cv2.log(luminance)
+        log_luminance *= 1 / np.log(2)
+
+        # Guided filter of the log luminance guided by itself, on the downscaled grid.
+        height, width = log_luminance.shape
+        grid_size = (max(width // self.downscale, 1), max(height // self.downscale, 1))
+        grid = cv2.resize(log_luminance, grid_size, interpolation=cv2.INTER_AREA)
+        radius = max(int(round(self.radius * max(grid.shape))), 1)
+        kernel_size = (2 * radius + 1, 2 * radius + 1)
+        mean = cv2.boxFilter(grid, -1, kernel_size, borderType=cv2.BORDER_REFLECT)
+        variance = cv2.boxFilter(grid * grid, -1, kernel_size, borderType=cv2.BORDER_REFLECT) - mean * mean
+        a = variance / (variance + self.epsilon)
+        b = mean - a * mean
+        a = cv2.boxFilter(a, -1, kernel_size, borderType=cv2.BORDER_REFLECT)
+        b = cv2.boxFilter(b, -1, kernel_size, borderType=cv2.BORDER_REFLECT)
+        a = cv2.resize(a, (width, height), interpolation=cv2.INTER_LINEAR)
+        b = cv2.resize(b, (width, height), interpolation=cv2.INTER_LINEAR)
+        base = a * log_luminance
+        base += b
+
+        # The brightest large scale areas keep their level, everything below is brought closer to it.
+        anchor = np.percentile(grid, 99.5)
+        log_gains = log_luminance - base
+        log_gains *= self.detail - 1
+        log_gains += (self.compression - 1) * (base - anchor)
+        log_gains *= np.log(2)
+        return cv2.exp(log_gains)
+
+    def set(self,
+            name=None,
+            input_magnitude=None,
+            input_black_level_correction=None,
+            input_black_level=None, input_white_level=None,
+            output_black_level=None, output_white_level=None,
+            output_dtype=None,
+            compression=None, detail=None,
+            radius=None, epsilon=None, downscale=None):
+        super()._set(name,
+                     input_magnitude,
+                     input_black_level_correction,
+                     input_black_level, input_white_level,
+                     output_black_level, output_white_level,
+                     output_dtype)
+        if compression is not None:
+            self.compression = compression
+        if detail is not None:
+            self.detail = detail
+        if radius is not None:
+            self.radius = radius
+        if epsilon is not None:
+            self.epsilon = epsilon
+        if downscale is not None:
+            self.downscale = downscale
+        self._update_tone_mapping_table()
+
+
+class ToneMapperJITMixin:
+    def _apply_tone_mapping_table(self, raw_image):
+        if not jit_kernels.JIT_AVAILABLE:
+            jit_kernels.warn_fallback(type(self).__name__)
+            return super()._apply_tone_mapping_table(raw_image)
+        raw_image = np.ascontiguousarray(raw_image)
+        if self.reuse_buffers:
+            out_raw_image = get_buffer(self._buffers, 'out', raw_image.shape, self._tone_mapping_table.dtype)
+        else:
+            out_raw_image = np.empty(raw_image.shape, dtype=self._tone_mapping_table.dtype)
+        jit_kernels.lut_gather(self._tone_mapping_table, raw_image.reshape(-1), out_raw_image.reshape(-1))
+        return out_raw_image
+
+
+class ToneMapperLinearJIT(ToneMapperJITMixin, ToneMapperLinear):
+    def __init__(self, name='linear_jit'):
+        super().__init__(name=name)
+
 
+class ToneMapperGammaCorrectionJIT(ToneMapperJITMixin, ToneMapperGammaCorrection):
+    def __init__(self, name='gamma_correction_jit', gamma: float = 1.0):
+        super().__init__(name=name, gamma=gamma)
@@ -8,9 +8,12 @@ from collections import OrderedDict
 
 from helper.get_attributes import get_attributes
 from helper.run_and_measure_time import run_and_measure_time
+from helper.get_buffer import get_buffer
 
 from core.image import Image
 
+from edit import jit_kernels
+
 
 class WhiteBalancer:
     def __init__(self, name: str = 'white_balancer', engine: str = None):
@@ -22,67 +25,136 @@ class WhiteBalancer:
         self.engines['camera'] = WhiteBalancerCamera()
         self.engines['white_patch'] = WhiteBalancerWhitePatch()
         self.engines['gray_world'] = WhiteBalancerGrayWorld()
+        self.engines['rgb_jit'] = WhiteBalancerRGBJIT()
+        self.engines['camera_jit'] = WhiteBalancerCameraJIT()
+        self.engines['white_patch_jit'] = WhiteBalancerWhitePatchJIT()
+        self.engines['gray_world_jit'] = WhiteBalancerGrayWorldJIT()
 
-    def process(self, image: Image):
+    def process(self, image: Image, statistics_image: Image = None):
         if self.engine is None:
             return
         if self.engine not in self.engines.keys():
             self.logger.error(f"WhiteBalancer engine {self.engine} does not exists.")
             raise ValueError
 
-        self.engines[self.engine].white_balance(image)
+        self.engines[self.engine].white_balance(image, statistics_image)
+
+    def needs_statistics(self):
+        return self.engine is not None and self.engines[self.engine].statistics
 
 
 class WhiteBalancerBase(ABC):
+    # Engines whose gains depend on statistics of the whole image, a region needs them from the image it is part of.
+    statistics = False
+
     def __init__(self,
                  input_magnitude: int = 2**14,
-                 input_black_level: int = 0, input_white_level: int = 2**12-1):
+                 input_black_level: int = 0, input_white_level: int = 2**12-1,
+                 fixed_point: bool = False,
+                 statistics_interval: int = 1, gains_smoothing: float = 0.0):
         self.name = None
         self.logger = logging.getLogger(f"eremore.{__name__}")
         self.input_magnitude = input_magnitude
         self.input_black_level = input_black_level
         self.input_white_level = input_white_level
+        self.fixed_point = fixed_point
+        # For sequences: image statistics are recomputed only every statistics_interval frames and the resulting
+        # gains are smoothed with an exponential moving average, gains_smoothing being the weight of the previous ones.
+        self.statistics_interval = statistics_interval
+        self.gains_smoothing = gains_smoothing
+        self.reuse_buffers = False
         self._white_balance_mapping_table = None
+        self._statistics_white_balance_mapping_table = None
+        self._frames_since_statistics = 0
+        self._previous_scales = None
+        self._region_statistics = None
+        self._buffers = {}
 
-    def white_balance(self, image: Image):
+    def white_balance(self, image: Image, statistics_image: Image = None):
         attributes = get_attributes(self)
-        arguments = {'image': image}
+        arguments = {'image': image, 'statistics_image': statistics_image}
         self.logger.debug(f"White balancing with -> attributes: {attributes} | arguments: {arguments}")
         run_and_measure_time(self._white_balance_wrapper, arguments, logger=self.logger)
 
-    def _white_balance_wrapper(self, image: Image):
-        if self._white_balance_mapping_table is None:
-            white_balance_mapping_table = self._get_white_balance_mapping_table(image)
-        else:
+    def _white_balance_wrapper(self, image: Image, statistics_image: Image = None):
+        if statistics_image is not None:
+            image.raw_image = self._apply_white_balance_mapping_table(
+                image.raw_image, self._get_region_white_balance_mapping_table(statistics_image))
+            return
+        if self._white_balance_mapping_table is not None:
             white_balance_mapping_table = self._white_balance_mapping_table
-        image.raw_image = np.stack([white_balance_mapping_table[0, image.raw_image[:, :, 0]],
-                                    white_balance_mapping_table[1, image.raw_image[:, :, 1]],
-                                    white_balance_mapping_table[2, image.raw_image[:, :, 2]]], axis=-1)
+        elif self._statistics_white_balance_mapping_table is not None and \
+                self._frames_since_statistics < self.statistics_interval:
+            white_balance_mapping_table = self._statistics_white_balance_mapping_table
+        else:
+            white_balance_mapping_table = self._get_white_balance_mapping_table(image)
+            self._statistics_white_balance_mapping_table = white_balance_mapping_table
+            self._frames_since_statistics = 0
+        self._frames_since_statistics += 1
+        image.raw_image = self._apply_white_balance_mapping_table(image.raw_image, white_balance_mapping_table)
+
+    def _get_region_white_balance_mapping_table(self, statistics_image: Image):
+        # Computed once per statistics image, regions panned over the same image share the gains. Regions are not
+        # part of a sequence, the gains are not smoothed and the smoothing state is left as it was.
+        if self._region_statistics is None or self._region_statistics[0] is not statistics_image:
+            previous_scales = self._previous_scales
+            self._previous_scales = None
+            self._region_statistics = (statistics_image, self._get_white_balance_mapping_table(statistics_image))
+            self._previous_scales = previous_scales
+        return self._region_statistics[1]
+
+    def _apply_white_balance_mapping_table(self, raw_image, white_balance_mapping_table):
+        if self.reuse_buffers:
+            out_raw_image = get_buffer(self._buffers, 'out', raw_image.shape, white_balance_mapping_table.dtype)
+            for c in range(3):
+                np.take(white_balance_mapping_table[c], raw_image[:, :, c], out=out_raw_image[:, :, c], mode='clip')
+            return out_raw_image
+        return np.stack([white_balance_mapping_table[0, raw_image[:, :, 0]],
+                         white_balance_mapping_table[1, raw_image[:, :, 1]],
+                         white_balance_mapping_table[2, raw_image[:, :, 2]]], axis=-1)
 
     @abstractmethod
     def _white_balance(self, white_balance_mapping_table, image: Image = None):
         pass
 
     def _get_white_balance_mapping_table(self, image: Image = None):
+        dtype = np.uint64 if self.fixed_point else np.float32
         white_balance_mapping_table = np.asarray([range(0, self.input_magnitude),
                                                   range(0, self.input_magnitude),
-                                                  range(0, self.input_magnitude)], dtype=np.float32)
+                                                  range(0, self.input_magnitude)], dtype=dtype)
         white_balance_mapping_table = np.clip(white_balance_mapping_table, self.input_black_level, self.input_white_level)
         white_balance_mapping_table = self._white_balance(white_balance_mapping_table, image)
         return white_balance_mapping_table.astype(dtype=np.uint16)
 
+    def _smooth_scales(self, scales):
+        scales = (scales * 3) / np.sum(scales)
+        if self._previous_scales is not None and self.gains_smoothing > 0:
+            scales = self.gains_smoothing * self._previous_scales + (1 - self.gains_smoothing) * scales
+            self.logger.debug(f"Smoothed color scales - > {scales}")
+        self._previous_scales = scales
+        return scales
+
     def set(self,
             name=None,
             input_magnitude=None,
-            input_black_level=None, input_white_level=None):
+            input_black_level=None, input_white_level=None,
+            fixed_point=None,
+            statistics_interval=None, gains_smoothing=None):
         self._set(name,
                   input_magnitude,
-                  input_black_level, input_white_level)
+                  input_black_level, input_white_level,
+                  fixed_point,
+                  statistics_interval, gains_smoothing)
 
     def _set(self,
              name=None,
              input_magnitude=None,
-             input_black_level=None, input_white_level=None):
+             input_black_level=None, input_white_level=None,
+             fixed_point=None,
+             statistics_interval=None, gains_smoothing=None):
+        self._statistics_white_balance_mapping_table = None
+        self._previous_scales = None
+        self._region_statistics = None
         if name is not None:
             self.name = name
             self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
@@ -92,6 +164,12 @@ class WhiteBalancerBase(ABC):
             self.input_black_level = input_black_level
         if input_white_level is not None:
             self.input_white_level = input_white_level
+        if fixed_point is not None:
+            self.fixed_point = fixed_point
+        if statistics_interval is not None:
+            self.statistics_interval = statistics_interval
+        if gains_smoothing is not None:
+            self.gains_smoothing = gains_smoothing
 
 
 class WhiteBalancerRGB(WhiteBalancerBase):
@@ -111,10 +189,14 @@ class WhiteBalancerRGB(WhiteBalancerBase):
             name=None,
             input_magnitude=None,
             input_black_level=None, input_white_level=None,
+            fixed_point=None,
+            statistics_interval=None, gains_smoothing=None,
             r_scale=None, g_scale=None, b_scale=None):
         super()._set(name,
                      input_magnitude,
-                     input_black_level, input_white_level)
+                     input_black_level, input_white_level,
+                     fixed_point,
+                     statistics_interval, gains_smoothing)
         if r_scale is not None:
             self.r_scale = r_scale
         if g_scale is not None:
@@ -136,10 +218,13 @@ class WhiteBalancerCamera(WhiteBalancerBase):
             scales = np.full(3, 1.0)
         else:
             scales = image.camera_white_balance
+        scales = self._smooth_scales(scales)
         return RGBScale.scale(white_balance_mapping_table, scales, normalize=True)
 
 
 class WhiteBalancerWhitePatch(WhiteBalancerBase):
+    statistics = True
+
     def __init__(self, name='white_patch', percentile: float = 0.97):
         super().__init__()
         self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
@@ -148,21 +233,27 @@ class WhiteBalancerWhitePatch(WhiteBalancerBase):
 
     def _white_balance(self, white_balance_mapping_table, image: Image):
         white = np.percentile(image.raw_image, q=self.percentile, axis=(0, 1))
-        scales = 1.0 / white
+        scales = self._smooth_scales(1.0 / white)
         return RGBScale.scale(white_balance_mapping_table, scales, normalize=True)
 
     def set(self, name=None,
             input_magnitude=None,
             input_black_level=None, input_white_level=None,
+            fixed_point=None,
+            statistics_interval=None, gains_smoothing=None,
             percentile=None):
         super()._set(name,
                      input_magnitude,
-                     input_black_level, input_white_level)
+                     input_black_level, input_white_level,
+                     fixed_point,
+                     statistics_interval, gains_smoothing)
         if percentile is not None:
             self.percentile = percentile
 
 
 class WhiteBalancerGrayWorld(WhiteBalancerBase):
+    statistics = True
+
     def __init__(self, name='gray_world'):
         super().__init__()
         self.logger = logging.getLogger(f"eremore.{__name__}.{name}")
@@ -170,17 +261,59 @@ class WhiteBalancerGrayWorld(WhiteBalancerBase):
 
     def _white_balance(self, white_balance_mapping_table, image: Image):
         gray = np.mean(image.raw_image, axis=(0, 1))
-        scales = 1.0 / gray
+        scales = self._smooth_scales(1.0 / gray)
         return RGBScale.scale(white_balance_mapping_table, scales, normalize=True)
 
 
+class WhiteBalancerJITMixin:
+    def _apply_white_balance_mapping_table(self, raw_image, white_balance_mapping_table):
+        if not jit_kernels.JIT_AVAILABLE:
+            jit_kernels.warn_fallback(type(self).__name__)
+            return super()._apply_white_balance_mapping_table(raw_image, white_balance_mapping_table)
+        raw_image = np.ascontiguousarray(raw_image)
+        if self.reuse_buffers:
+            out_raw_image = get_buffer(self._buffers, 'out', raw_image.shape, white_balance_mapping_table.dtype)
+        else:
+            out_raw_image = np.empty(raw_image.shape, dtype=white_balance_mapping_table.dtype)
+        jit_kernels.lut_gather_rgb(white_balance_mapping_table, raw_image.reshape(-1, 3), out_raw_image.reshape(-1, 3))
+        return out_raw_image
+
+
+class WhiteBalancerRGBJIT(WhiteBalancerJITMixin, WhiteBalancerRGB):
+    def __init__(self, name='rgb_scale_jit', r_scale: float = 1, g_scale: float = 1, b_scale: float = 1):
+        super().__init__(name=name, r_scale=r_scale, g_scale=g_scale, b_scale=b_scale)
+
+
+class WhiteBalancerCameraJIT(WhiteBalancerJITMixin, WhiteBalancerCamera):
+    def __init__(self, name='camera_jit'):
+        super().__init__(name=name)
+
+
+class WhiteBalancerWhitePatchJIT(WhiteBalancerJITMixin, WhiteBalancerWhitePatch):
+    def __init__(self, name='white_patch_jit', percentile: float = 0.97):
+        super().__init__(name=name, percentile=percentile)
+
+
+class WhiteBalancerGrayWorldJIT(WhiteBalancerJITMixin, WhiteBalancerGrayWorld):
+    def __init__(self, name='gray_world_jit'):
+        super().__init__(name=name)
+
+
 class RGBScale:
     logger = logging.getLogger(f"eremore.{__name__}.rgb_scale")
+    fraction_bits = 16
 
     @staticmethod
     def scale(white_balance_mapping_table, scales, normalize=False):
         if normalize:
             scales = (scales * 3) / np.sum(scales)
             RGBScale.logger.debug(f"Normalized color scales - > {scales}")
-        white_balance_mapping_table *= np.expand_dims(scales, axis=1)
+        if np.issubdtype(white_balance_mapping_table.dtype, np.integer):
+            fixed_point_scales = np.round(np.asarray(scales) * 2**RGBScale.fraction_bits)
+            RGBScale.logger.debug(f"Fixed point color scales - > {fixed_point_scales}")
+            white_balance_mapping_table *= np.expand_dims(fixed_point_scales.astype(white_balance_mapping_table.dtype),
+                                                          axis=1)
+            white_balance_mapping_table >>= RGBScale.fraction_bits
+        else:
+            white_balance_mapping_table *= np.expand_dims(scales, axis=1)
         return white_balance_mapping_table
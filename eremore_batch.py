@@ -0,0 +1,315 @@
+import io
+import os
+import logging
+import argparse
+import resource
+import sys
+import time
+import traceback
+
+from contextlib import redirect_stderr
+from multiprocessing import Process, Pipe, Value, Condition
+from pathlib import Path
+
+from core.loader import Loader
+from core.spool_queue import SpoolQueue, SpoolManifest, Heartbeat, get_worker_id
+
+import eremore_console
+
+logger = logging.getLogger(f"eremore.{__name__}")
+
+# Bytes per RAW pixel of the output of an engine and at its peak including the output, measured with tracemalloc.
+# Tune them with the estimated and peak memory the workers write to the manifest.
+LOADER_MEMORY = (2, 6)
+# The dark frame offsets stay cached next to the output.
+SENSOR_CORRECTOR_MEMORY = {'dark_frame': (4, 8), 'flat_field': (2, 6), 'bad_pixel': (2, 2)}
+TONE_MAPPER_MEMORY = {'linear': (2, 2), 'gamma_correction': (2, 2), 'local': (2, 9)}
+DEMOSAICER_MEMORY = {'bayer_splitter': (6, 6), 'copy': (6, 7), 'linear': (6, 28), 'linear_fixed_point': (6, 18)}
+WHITE_BALANCER_MEMORY = (6, 12)
+COLOR_CORRECTOR_MEMORY = {'matrix': (6, 30), 'lut_3d': (6, 7)}
+# Tables and allocations of a job independent of the image size.
+JOB_MEMORY_OVERHEAD = 12 * 2**20
+
+
+def parseargs(argv=None):
+    print(' '.join(sys.argv if argv is None else [sys.argv[0]] + list(argv)))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--spool-directory', required=True, type=str,
+                        help="Directory of the job queue, shared by all workers.")
+    parser.add_argument('--logging-level', default=logging.INFO)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_submit = subparsers.add_parser('submit', help="Add a job per RAW image, arguments not listed here are "
+                                                         "passed to eremore_console.")
+    parser_submit.add_argument('--path-to-raw-image', required=True, type=str, nargs='+')
+    parser_submit.add_argument('--path-to-export-image', required=True, type=str, nargs='+',
+                               help="Formatted with {index} and {name} of each RAW image, e.g. 'out/{name}.png'.")
+    parser_submit.add_argument('--skip-existing', action='store_true',
+                               help="Do not submit RAW images whose exported images all exist already.")
+
+    parser_work = subparsers.add_parser('work', help="Process jobs until stopped.")
+    parser_work.add_argument('--workers', default=1, type=int, help="Number of worker processes on this host.")
+    parser_work.add_argument('--heartbeat-interval', default=10.0, type=float)
+    parser_work.add_argument('--stale-timeout', default=60.0, type=float,
+                             help="Requeue running jobs without a heartbeat for this many seconds.")
+    parser_work.add_argument('--poll-interval', default=1.0, type=float)
+    parser_work.add_argument('--exit-when-empty', action='store_true',
+                             help="Stop once no job is pending or running.")
+    parser_work.add_argument('--job-timeout', type=float, help="Fail jobs running longer than this many seconds.")
+    parser_work.add_argument('--max-attempts', default=3, type=int,
+                             help="Failed jobs are requeued until they failed this many times.")
+    parser_work.add_argument('--memory-budget', type=float,
+                             help="MiB of image data the workers of this host may hold at once, a job starts once "
+                                  "its estimated peak fits.")
+
+    parser_status = subparsers.add_parser('status', help="Print the number of jobs in each state.")
+    parser_status.add_argument('--failed', action='store_true', help="List the failed jobs with their errors.")
+
+    args, console_argv = parser.parse_known_args(argv)
+    args.console_argv = console_argv
+    return args
+
+
+def parse_console_argv(argv):
+    # argparse prints the usage and the error on stderr and exits, the error is returned instead.
+    stderr = io.StringIO()
+    try:
+        with redirect_stderr(stderr):
+            return eremore_console.parseargs(argv, print_argv=False), None
+    except SystemExit as system_exit:
+        lines = stderr.getvalue().strip().splitlines()
+        return None, lines[-1] if lines else f"Console arguments exited with code {system_exit.code}."
+
+
+def submit(spool_queue: SpoolQueue, args):
+    jobs = []
+    for index, path_to_raw_image in enumerate(args.path_to_raw_image):
+        name = Path(path_to_raw_image).stem
+        paths_to_export_image = [path_to_export_image.format(index=index, name=name)
+                                 for path_to_export_image in args.path_to_export_image]
+        if args.skip_existing and all(os.path.exists(path) for path in paths_to_export_image):
+            logger.info(f"Skipping {path_to_raw_image}, its exported images exist.")
+            continue
+        argv = ['--path-to-raw-image', path_to_raw_image, '--path-to-export-image', *paths_to_export_image,
+                *args.console_argv]
+        jobs.append((argv, {'path_to_raw_image': path_to_raw_image, 'paths_to_export_image': paths_to_export_image}))
+
+    # A job the console rejects would fail on every attempt, nothing is submitted then.
+    for argv, metadata in jobs:
+        _, error = parse_console_argv(argv)
+        if error is not None:
+            logger.error(f"Invalid console arguments for {metadata['path_to_raw_image']}, no job was submitted:\n"
+                         f"{error}")
+            raise ValueError
+
+    for argv, metadata in jobs:
+        job_id = spool_queue.submit(argv, metadata=metadata)
+        logger.info(f"Submitted {metadata['path_to_raw_image']} as job {job_id}.")
+
+
+def estimate_memory(args, shape):
+    # Peak bytes of a render of a RAW image of shape with the engines selected by the console args. The editor keeps
+    # the input of every engine and copies it before processing, so the peak is reached while an engine runs on top
+    # of all images kept so far. The branches run one after another and keep their images too.
+    height, width = shape
+    stages = [LOADER_MEMORY]
+    for sensor_corrector in ['dark_frame', 'flat_field', 'bad_pixel']:
+        if sensor_corrector in (args.sensor_corrector or []):
+            stages.append(SENSOR_CORRECTOR_MEMORY[sensor_corrector])
+    if args.tone_mapper is not None:
+        stages.append(TONE_MAPPER_MEMORY[args.tone_mapper])
+    if args.demosaicer is not None:
+        demosaicer = 'linear_fixed_point' if args.fixed_point and args.demosaicer == 'linear' else args.demosaicer
+        stages.append(DEMOSAICER_MEMORY[demosaicer])
+    if args.white_balancer is not None:
+        stages.append(WHITE_BALANCER_MEMORY)
+    if args.color_corrector is not None:
+        stages.append(COLOR_CORRECTOR_MEMORY[args.color_corrector])
+    retained, current, peak = 0.0, 0.0, 0.0
+    for output, working in stages:
+        peak = max(peak, retained + current + working)
+        retained, current = retained + output, output
+
+    output_bytes = 3 if args.fixed_point and args.output_white_level <= 2**8-1 else 6
+    branch_input = current
+    for export_max_size in args.export_max_size or [0]:
+        scale = min(export_max_size / max(height, width), 1.0) ** 2 if export_max_size > 0 else 1.0
+        current = branch_input
+        stages = [(branch_input * scale, branch_input * scale)] if scale < 1.0 else []
+        stages.append((output_bytes * scale, output_bytes * scale))
+        if args.rotator is not None:
+            stages.append((output_bytes * scale, 0))
+        stages.append((output_bytes * scale, (9 if output_bytes == 6 else 3) * scale))
+        for output, working in stages:
+            peak = max(peak, retained + current + working)
+            retained, current = retained + output, output
+    return int(peak * height * width) + JOB_MEMORY_OVERHEAD
+
+
+def estimate_job_memory(args):
+    loader = Loader(engine=args.loader)
+    loader.engines[loader.engine].set(path_to_raw_image=args.path_to_raw_image[0], camera_id=args.camera_id)
+    try:
+        shape = loader.engines[loader.engine].get_shape()
+    except Exception as error:
+        # The job fails the same way when it runs, there is nothing to reserve for it.
+        logger.warning(f"Could not read the shape of {args.path_to_raw_image[0]}: {error}")
+        return 0
+    return estimate_memory(args, shape)
+
+
+class MemoryBudget:
+    # Memory shared by the workers of a host, a job is admitted once its estimate fits next to the running ones. A job
+    # larger than the whole budget runs alone. Jobs are admitted in the order they asked, a large job waiting for
+    # memory holds back the small ones behind it instead of being overtaken by them forever.
+    def __init__(self, budget: float):
+        self.budget = budget
+        self._used = Value('d', 0.0, lock=False)
+        self._next_ticket = Value('q', 0, lock=False)
+        self._serving_ticket = Value('q', 0, lock=False)
+        self._condition = Condition()
+
+    def acquire(self, memory: float):
+        with self._condition:
+            ticket = self._next_ticket.value
+            self._next_ticket.value += 1
+            while self._serving_ticket.value != ticket or \
+                    (self._used.value > 0 and self._used.value + memory > self.budget):
+                self._condition.wait()
+            self._used.value += memory
+            self._serving_ticket.value += 1
+            self._condition.notify_all()
+
+    def release(self, memory: float):
+        with self._condition:
+            self._used.value -= memory
+            self._condition.notify_all()
+
+
+def run_job(argv, connection):
+    # ru_maxrss is in KiB on Linux, a forked process starts with its resident size at the fork.
+    start_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    error = None
+    try:
+        eremore_console.run(eremore_console.parseargs(argv))
+    except Exception:
+        error = traceback.format_exc()
+    peak_memory = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_memory) * 1024
+    connection.send((error, peak_memory))
+    if error is not None:
+        sys.exit(1)
+
+
+def run_isolated_job(job, timeout: float = None):
+    # Runs the job in a child process, a crash, a hang or a leak of a single RAW image does not affect the worker.
+    # Returns the error or None on success and the peak memory of the job if it finished.
+    receiver, sender = Pipe(duplex=False)
+    process = Process(target=run_job, args=(job['argv'], sender))
+    process.start()
+    sender.close()
+    process.join(timeout)
+    if process.is_alive():
+        process.kill()
+        process.join()
+        return f"Timed out after {timeout} s.", None
+    try:
+        return receiver.recv()
+    except EOFError:
+        # Closed without a message, the process crashed.
+        return f"Job process exited with code {process.exitcode}.", None
+
+
+def work(args, memory_budget: MemoryBudget = None):
+    logging.basicConfig(format='%(name)s %(levelname)-8s %(message)s', level=args.logging_level)
+    spool_queue = SpoolQueue(args.spool_directory)
+    worker_id = get_worker_id()
+    spool_manifest = SpoolManifest(args.spool_directory, worker_id=worker_id)
+    logger.info(f"Worker {worker_id} started.")
+    while True:
+        spool_queue.requeue_stale(args.stale_timeout)
+        job = spool_queue.claim()
+        if job is None:
+            counts = spool_queue.get_counts()
+            if args.exit_when_empty and counts['pending'] == 0 and counts['running'] == 0:
+                break
+            time.sleep(args.poll_interval)
+            continue
+
+        with Heartbeat(spool_queue, job['id'], args.heartbeat_interval):
+            # A job whose arguments cannot be estimated, e.g. submitted by another version, fails without running.
+            estimated_memory, peak_memory, wait_time, elapsed_time = 0, None, 0.0, 0.0
+            try:
+                console_args, error = parse_console_argv(job['argv'])
+                if error is None:
+                    estimated_memory = estimate_job_memory(console_args)
+            except Exception:
+                error = traceback.format_exc()
+            if error is None:
+                start = time.time()
+                if memory_budget is not None:
+                    memory_budget.acquire(estimated_memory)
+                wait_time = time.time() - start
+                logger.info(f"Worker {worker_id} processing job {job['id']}, estimated memory "
+                            f"{estimated_memory / 2**20:.0f} MiB, waited {wait_time:.2f} s.")
+                start = time.time()
+                try:
+                    error, peak_memory = run_isolated_job(job, timeout=args.job_timeout)
+                finally:
+                    if memory_budget is not None:
+                        memory_budget.release(estimated_memory)
+                elapsed_time = time.time() - start
+
+        memory = {'wait_time': round(wait_time, 3), 'estimated_memory': estimated_memory, 'peak_memory': peak_memory}
+        if error is None:
+            spool_manifest.record(job, 'completed', elapsed_time, **memory)
+            spool_queue.complete(job['id'])
+            logger.info(f"Worker {worker_id} finished job {job['id']} in {elapsed_time:.2f} s, peak memory "
+                        f"{peak_memory / 2**20:.0f} MiB.")
+            continue
+        spool_manifest.record(job, 'failed', elapsed_time, error=error, **memory)
+        job['attempts'] = job.get('attempts', 0) + 1
+        if job['attempts'] < args.max_attempts:
+            logger.warning(f"Job {job['id']} failed, attempt {job['attempts']} of {args.max_attempts}: {error}")
+            spool_queue.retry(job)
+        else:
+            logger.error(f"Job {job['id']} failed: {error}")
+            spool_queue.fail(job['id'])
+    logger.info(f"Worker {worker_id} stopped, no jobs left.")
+
+
+def main():
+    args = parseargs()
+    logging.basicConfig(format='%(name)s %(levelname)-8s %(message)s', level=args.logging_level)
+    spool_queue = SpoolQueue(args.spool_directory)
+
+    if args.command == 'submit':
+        submit(spool_queue, args)
+    elif args.command == 'status':
+        print(spool_queue.get_counts())
+        entries = SpoolManifest(args.spool_directory).load().values()
+        completed = [entry for entry in entries if entry['state'] == 'completed']
+        if completed:
+            elapsed_times = [entry['elapsed_time'] for entry in completed]
+            print(f"completed: {len(completed)} | total time: {sum(elapsed_times):.1f} s | "
+                  f"mean time: {sum(elapsed_times) / len(elapsed_times):.2f} s")
+            memory_ratios = [entry['peak_memory'] / entry['estimated_memory'] for entry in completed
+                             if entry.get('peak_memory') and entry.get('estimated_memory')]
+            if memory_ratios:
+                print(f"peak / estimated memory: mean {sum(memory_ratios) / len(memory_ratios):.2f} | "
+                      f"min {min(memory_ratios):.2f} | max {max(memory_ratios):.2f}")
+        if args.failed:
+            for entry in entries:
+                if entry['state'] == 'failed' and spool_queue.get_state(entry['id']) == 'failed':
+                    print(f"{entry['id']} {entry.get('path_to_raw_image')} attempts: {entry['attempt']}\n"
+                          f"{entry['error']}")
+    elif args.command == 'work':
+        memory_budget = MemoryBudget(args.memory_budget * 2**20) if args.memory_budget is not None else None
+        workers = [Process(target=work, args=(args, memory_budget)) for _ in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,20 +3,28 @@ import argparse
 import sys
 
 from functools import partial
+from pathlib import Path
+
+import numpy as np
 
 from core.loader import Loader
 from edit.editor import Editor
+from edit.sensor_corrector import SensorCorrector
 from edit.demosaicer import Demosaicer
 from edit.tone_mapper import ToneMapper
 from edit.white_balancer import WhiteBalancer
+from edit.color_corrector import ColorCorrector
 from edit.rotator import Rotator
+from edit.resizer import Resizer
 from core.exporter import Exporter
+from edit import jit_kernels
 
 logger = logging.getLogger(f"eremore.{__name__}")
 
 
-def parseargs():
-    print(' '.join(sys.argv))
+def parseargs(argv=None, print_argv: bool = True):
+    if print_argv:
+        print(' '.join(sys.argv if argv is None else [sys.argv[0]] + list(argv)))
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--input-magnitude', default=2**14, type=int)
@@ -24,20 +32,45 @@ def parseargs():
     parser.add_argument('--input-white-level', default=2**12-1, type=int)
     parser.add_argument('--output-black-level', default=0, type=int)
     parser.add_argument('--output-white-level', default=255, type=int)
+    parser.add_argument('--jit', action='store_true',
+                        help="Use the numba compiled variants of the selected engines if numba is installed.")
+    parser.add_argument('--fixed-point', action='store_true',
+                        help="Use integer arithmetic only: fixed point linear demosaicing and white balance gains "
+                             "and uint8 output of the output linear tone mapper.")
 
     group_loader = parser.add_argument_group('Loader')
     group_loader.add_argument('--loader', default='raw_py', choices=['raw_py'])
-    group_loader.add_argument('--path-to-raw-image', required=True, type=str, help="Path to the RAW image.")
+    group_loader.add_argument('--path-to-raw-image', required=True, type=str, nargs='+',
+                              help="Path to the RAW image, several paths are processed as a sequence.")
+    group_loader.add_argument('--camera-id', type=str, help="Camera body the RAW images were taken with.")
+
+    group_sensor_corrector = parser.add_argument_group('SensorCorrector')
+    group_sensor_corrector.add_argument('--sensor-corrector', nargs='+',
+                                        choices=['dark_frame', 'flat_field', 'bad_pixel'],
+                                        help="Corrections applied in the order dark_frame, flat_field, bad_pixel with "
+                                             "the calibrations in calibration_directory/camera_id.")
+    group_sensor_corrector.add_argument('--calibration-directory', type=str)
+    group_sensor_corrector.add_argument('--flat-field-downscale', default=16, type=int,
+                                        help="Downscale of the flat field gains kept in memory.")
 
     group_tone_mapper = parser.add_argument_group('ToneMapper')
-    group_tone_mapper.add_argument('--tone-mapper', choices=['linear', 'gamma_correction'])
+    group_tone_mapper.add_argument('--tone-mapper', choices=['linear', 'gamma_correction', 'local'])
     group_tone_mapper.add_argument('--input-black-level-correction', default=0, type=int)
 
     group_tone_mapper_gamma_correction = parser.add_argument_group('ToneMapperGammaCorrection')
     group_tone_mapper_gamma_correction.add_argument('--gamma', default=1, type=float)
 
+    group_tone_mapper_local = parser.add_argument_group('ToneMapperLocal')
+    group_tone_mapper_local.add_argument('--compression', default=0.5, type=float,
+                                         help="Factor of the large scale contrast in stops, 1 keeps it.")
+    group_tone_mapper_local.add_argument('--detail', default=1.0, type=float, help="Factor of the local details.")
+    group_tone_mapper_local.add_argument('--radius', default=0.02, type=float,
+                                         help="Radius of the filter relative to the longest side of the image.")
+    group_tone_mapper_local.add_argument('--epsilon', default=0.1, type=float,
+                                         help="Edges of about sqrt(epsilon) stops and more are kept.")
+
     group_demosaicer = parser.add_argument_group('Demosaicer')
-    group_demosaicer.add_argument('--demosaicer', choices=['bayer_splitter', 'copy', 'linear'])
+    group_demosaicer.add_argument('--demosaicer', choices=['bayer_splitter', 'copy', 'linear', 'linear_fixed_point'])
     group_demosaicer.add_argument('--blue-loc', default='11', choices=['00', '01', '10', '11'])
 
     group_white_balancer = parser.add_argument_group('WhiteBalancer')
@@ -48,6 +81,17 @@ def parseargs():
     group_white_balancer_rgb.add_argument('--b-scale', default=1, type=int)
     group_white_balancer_white_patch = parser.add_argument_group('WhiteBalancerWhitePatch')
     group_white_balancer_white_patch.add_argument('--percentile', default=97, type=float)
+    group_white_balancer_sequence = parser.add_argument_group('WhiteBalancer sequence')
+    group_white_balancer_sequence.add_argument('--statistics-interval', default=1, type=int,
+                                               help="Recompute the white balance statistics every N frames.")
+    group_white_balancer_sequence.add_argument('--gains-smoothing', default=0.0, type=float,
+                                               help="Weight of the previous frame gains, 0 disables smoothing.")
+
+    group_color_corrector = parser.add_argument_group('ColorCorrector')
+    group_color_corrector.add_argument('--color-corrector', choices=['matrix', 'lut_3d'])
+    group_color_corrector.add_argument('--output-gamma', default=1, type=float)
+    group_color_corrector_lut_3d = parser.add_argument_group('ColorCorrectorLUT3D')
+    group_color_corrector_lut_3d.add_argument('--lut-size', default=33, type=int)
 
     group_rotator = parser.add_argument_group('Rotator')
     group_rotator.add_argument('--rotator', choices=['90'])
@@ -56,34 +100,83 @@ def parseargs():
 
     group_exporter = parser.add_argument_group('Exporter')
     group_exporter.add_argument('--exporter', default='open_cv', choices=['open_cv'])
-    group_exporter.add_argument('--path-to-export-image', required=True, type=str, help="Path to save the exported image.")
+    group_exporter.add_argument('--path-to-export-image', required=True, type=str, nargs='+',
+                                help="Path to save the exported image, several paths render several outputs from one "
+                                     "load. For sequences it is formatted with {index} and {name} of each frame, "
+                                     "e.g. 'out/{index:05d}.png'.")
+    group_exporter.add_argument('--export-max-size', type=int, nargs='+',
+                                help="Longest side of each exported image, 0 keeps the full size.")
+    group_exporter.add_argument('--jpeg-quality', type=int)
+
+    group_sequence = parser.add_argument_group('Sequence')
+    group_sequence.add_argument('--target-fps', type=float, help="Warn about frames processed slower than this.")
 
     parser.add_argument('--logging-level', default=logging.INFO)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
 
-def main():
-    args = parseargs()
-    #logging.basicConfig(format='%(name)s %(asctime)s %(levelname)-8s %(message)s', level=args.logging_level,
-    #                    datefmt='%Y-%m-%d %H:%M:%S')
-    logging.basicConfig(format='%(name)s %(levelname)-8s %(message)s', level=args.logging_level)
+def use_jit_engine(stage):
+    jit_engine = f"{stage.engine}_jit"
+    if not jit_kernels.JIT_AVAILABLE or jit_engine not in stage.engines:
+        return False
+    stage.engine = jit_engine
+    return True
+
 
+def run(args):
     # Loader
     # ##################################################################################################################
     loader = Loader(engine=args.loader)
-    loader.engines[loader.engine].set(path_to_raw_image=args.path_to_raw_image)
 
-    image = loader.process()
+    def load(path_to_raw_image):
+        loader.engines[loader.engine].set(path_to_raw_image=path_to_raw_image, camera_id=args.camera_id)
+        return loader.process()
+
+    def format_path_to_export_image(path_to_export_image, index, path_to_raw_image):
+        return path_to_export_image.format(index=index, name=Path(path_to_raw_image).stem)
+
+    sequence = len(args.path_to_raw_image) > 1
+    if sequence:
+        # Every frame needs its own file, a path without {index} or {name} would be overwritten by each frame.
+        for path_to_export_image in args.path_to_export_image:
+            paths = {format_path_to_export_image(path_to_export_image, index, path_to_raw_image)
+                     for index, path_to_raw_image in enumerate(args.path_to_raw_image)}
+            if len(paths) < len(args.path_to_raw_image):
+                logger.error(f"Export path {path_to_export_image} is shared by several frames of the sequence, "
+                             f"format it with {{index}} or {{name}}.")
+                raise ValueError
+    image = None if sequence else load(args.path_to_raw_image[0])
     # ##################################################################################################################
 
     editor = Editor(name='editor', input_image=image)
 
+    # SensorCorrector
+    # ##################################################################################################################
+    for sensor_corrector_engine in ['dark_frame', 'flat_field', 'bad_pixel']:
+        if sensor_corrector_engine not in (args.sensor_corrector or []):
+            continue
+        sensor_corrector = SensorCorrector(name=f"{sensor_corrector_engine}_corrector", engine=sensor_corrector_engine)
+        sensor_corrector_set = partial(sensor_corrector.engines[sensor_corrector.engine].set,
+                                       calibration_directory=args.calibration_directory,
+                                       input_black_level=args.input_black_level_correction,
+                                       input_white_level=args.input_magnitude - 1)
+        if sensor_corrector_engine == 'flat_field':
+            sensor_corrector_set(downscale=args.flat_field_downscale)
+        else:
+            sensor_corrector_set()
+
+        editor.add_engine(sensor_corrector)
+        editor.register_engine_for_update(sensor_corrector.name)
+    # ##################################################################################################################
+
     # ToneMapper
     # ##################################################################################################################
     if args.tone_mapper is not None:
         tone_mapper = ToneMapper(engine=args.tone_mapper)
+        if args.jit:
+            use_jit_engine(tone_mapper)
         tone_mapper_set = partial(tone_mapper.engines[tone_mapper.engine].set,
                                   input_magnitude=args.input_magnitude,
                                   input_black_level_correction=args.input_black_level_correction,
@@ -91,8 +184,11 @@ def main():
                                   input_white_level=args.input_white_level,
                                   output_black_level=args.input_black_level,
                                   output_white_level=args.input_white_level)
-        if tone_mapper.engine == 'gamma_correction':
+        if args.tone_mapper == 'gamma_correction':
             tone_mapper_set(gamma=args.gamma)
+        elif args.tone_mapper == 'local':
+            tone_mapper_set(compression=args.compression, detail=args.detail, radius=args.radius,
+                            epsilon=args.epsilon)
         else:
             tone_mapper_set()
 
@@ -105,6 +201,11 @@ def main():
     if args.demosaicer is not None:
         blue_loc = (int(args.blue_loc[0]), int(args.blue_loc[1]))
         demosaicer = Demosaicer(engine=args.demosaicer)
+        if args.jit:
+            use_jit_engine(demosaicer)
+        # The JIT engine takes precedence, the fixed point engine replaces only the NumPy float one.
+        if args.fixed_point and demosaicer.engine == 'linear':
+            demosaicer.engine = 'linear_fixed_point'
         demosaicer.engines[demosaicer.engine].set(blue_loc=blue_loc)
 
         editor.add_engine(demosaicer)
@@ -115,11 +216,16 @@ def main():
     # ##################################################################################################################
     if args.white_balancer is not None:
         white_balancer = WhiteBalancer(engine=args.white_balancer)
+        if args.jit:
+            use_jit_engine(white_balancer)
         white_balancer_set = partial(white_balancer.engines[white_balancer.engine].set,
                                      input_magnitude=args.input_white_level + 1,
                                      input_black_level=args.input_black_level,
-                                     input_white_level=args.input_white_level)
-        if white_balancer.engine == 'white_patch':
+                                     input_white_level=args.input_white_level,
+                                     fixed_point=args.fixed_point,
+                                     statistics_interval=args.statistics_interval,
+                                     gains_smoothing=args.gains_smoothing)
+        if args.white_balancer == 'white_patch':
             white_balancer_set(percentile=args.percentile)
         else:
             white_balancer_set()
@@ -128,42 +234,121 @@ def main():
         editor.register_engine_for_update(white_balancer.name)
     # ##################################################################################################################
 
-    # Output Liner ToneMapper
-    # ##################################################################################################################
-    output_linear_tone_mapper = ToneMapper(name='output_linear_tone_mapper', engine='linear')
-    output_linear_tone_mapper.engines[output_linear_tone_mapper.engine].set(name='output_linear',
-                                                                            input_magnitude=args.input_magnitude,
-                                                                            input_black_level_correction=0,
-                                                                            input_black_level=args.input_black_level,
-                                                                            input_white_level=args.input_white_level,
-                                                                            output_black_level=args.output_black_level,
-                                                                            output_white_level=args.output_white_level)
-
-    editor.add_engine(output_linear_tone_mapper)
-    editor.register_engine_for_update(output_linear_tone_mapper.name)
+    # ColorCorrector
     # ##################################################################################################################
+    if args.color_corrector is not None:
+        color_corrector = ColorCorrector(engine=args.color_corrector)
+        if args.jit:
+            use_jit_engine(color_corrector)
+        if color_corrector.engine == 'lut_3d':
+            # In NumPy the LUT interpolation is slower than the matrix it replaces.
+            logger.error(f"The lut_3d color corrector needs --jit and numba, use the matrix color corrector otherwise.")
+            raise ValueError
+        color_corrector_set = partial(color_corrector.engines[color_corrector.engine].set,
+                                      input_black_level=args.input_black_level,
+                                      input_white_level=args.input_white_level,
+                                      output_black_level=args.input_black_level,
+                                      output_white_level=args.input_white_level,
+                                      gamma=args.output_gamma)
+        if args.color_corrector == 'lut_3d':
+            color_corrector_set(lut_size=args.lut_size)
+        else:
+            color_corrector_set()
 
-    # Rotator
+        editor.add_engine(color_corrector)
+        editor.register_engine_for_update(color_corrector.name)
     # ##################################################################################################################
-    if args.rotator is not None:
-        rotator = Rotator(engine=args.rotator)
-        if rotator.engine == '90':
-            rotator.engines['90'].set(k=args.k)
 
-        editor.add_engine(rotator)
-        editor.register_engine_for_update(rotator.name)
+    # Outputs
+    # ##################################################################################################################
+    export_max_sizes = args.export_max_size or [0]
+    if len(export_max_sizes) == 1:
+        export_max_sizes = export_max_sizes * len(args.path_to_export_image)
+    if len(export_max_sizes) != len(args.path_to_export_image):
+        logger.error(f"Got {len(export_max_sizes)} export max sizes for {len(args.path_to_export_image)} outputs.")
+        raise ValueError
+
+    exporters = []
+    for index, export_max_size in enumerate(export_max_sizes):
+        output_editor = Editor(name=f"output_{index}", input_image=None)
+
+        # Resizer
+        # ##############################################################################################################
+        if export_max_size > 0:
+            resizer = Resizer(engine='open_cv')
+            resizer.engines['open_cv'].set(max_size=export_max_size)
+
+            output_editor.add_engine(resizer)
+        # ##############################################################################################################
+
+        # Output Liner ToneMapper
+        # ##############################################################################################################
+        output_dtype = np.uint8 if args.fixed_point and args.output_white_level <= 2**8-1 else np.uint16
+        output_linear_tone_mapper = ToneMapper(name='output_linear_tone_mapper', engine='linear')
+        if args.jit:
+            use_jit_engine(output_linear_tone_mapper)
+        output_linear_tone_mapper.engines[output_linear_tone_mapper.engine].set(
+            name='output_linear',
+            input_magnitude=args.input_magnitude,
+            input_black_level_correction=0,
+            input_black_level=args.input_black_level,
+            input_white_level=args.input_white_level,
+            output_black_level=args.output_black_level,
+            output_white_level=args.output_white_level,
+            output_dtype=output_dtype)
+
+        output_editor.add_engine(output_linear_tone_mapper)
+        # ##############################################################################################################
+
+        # Rotator
+        # ##############################################################################################################
+        if args.rotator is not None:
+            rotator = Rotator(engine=args.rotator)
+            if rotator.engine == '90':
+                rotator.engines['90'].set(k=args.k)
+
+            output_editor.add_engine(rotator)
+        # ##############################################################################################################
+
+        # Exporter
+        # ##############################################################################################################
+        exporter = Exporter(engine=args.exporter)
+        exporter.engines[exporter.engine].set(jpeg_quality=args.jpeg_quality)
+        exporters.append(exporter)
+
+        output_editor.add_engine(exporter)
+        # ##############################################################################################################
+
+        editor.add_branch(output_editor)
     # ##################################################################################################################
 
+    def set_paths_to_export_image(index, path_to_raw_image):
+        for exporter, path_to_export_image in zip(exporters, args.path_to_export_image):
+            if sequence:
+                path_to_export_image = format_path_to_export_image(path_to_export_image, index, path_to_raw_image)
+            exporter.engines[exporter.engine].set(path_to_export_image=path_to_export_image)
 
-    editor.process()
+    if not sequence:
+        set_paths_to_export_image(0, args.path_to_raw_image[0])
+        editor.process()
+        return
 
-    # Exporter
-    # ##################################################################################################################
-    exporter = Exporter(engine=args.exporter)
-    exporter.engines[exporter.engine].set(path_to_export_image=args.path_to_export_image)
+    def load_frame(index, path_to_raw_image):
+        # Frames are loaded lazily right before they are processed, so the exporters can be pointed at their paths.
+        set_paths_to_export_image(index, path_to_raw_image)
+        return load(path_to_raw_image)
 
-    exporter.process(editor.output_image)
-    # ##################################################################################################################
+    input_images = map(load_frame, range(len(args.path_to_raw_image)), args.path_to_raw_image)
+    for _ in editor.process_sequence(input_images, target_fps=args.target_fps):
+        pass
+
+
+def main():
+    args = parseargs()
+    #logging.basicConfig(format='%(name)s %(asctime)s %(levelname)-8s %(message)s', level=args.logging_level,
+    #                    datefmt='%Y-%m-%d %H:%M:%S')
+    logging.basicConfig(format='%(name)s %(levelname)-8s %(message)s', level=args.logging_level)
+    run(args)
 
 
 if __name__ == '__main__':
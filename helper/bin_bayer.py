@@ -0,0 +1,16 @@
+import numpy as np
+
+
+def bin_bayer(raw_image, binning: int):
+    # Averages binning x binning pixels of each of the four Bayer phases separately, the result is a smaller mosaic
+    # with the same layout, so blue_loc stays valid. The last rows and columns not filling a block are dropped.
+    cell = 2 * binning
+    height, width = raw_image.shape[0] // cell * cell, raw_image.shape[1] // cell * cell
+    sum_dtype = np.int64 if np.issubdtype(raw_image.dtype, np.signedinteger) else np.uint32
+    binned_raw_image = np.empty((height // binning, width // binning), dtype=raw_image.dtype)
+    for i in range(2):
+        for j in range(2):
+            phase = raw_image[i:height:2, j:width:2].reshape(height // cell, binning, width // cell, binning)
+            binned_raw_image[i::2, j::2] = np.sum(phase, axis=(1, 3), dtype=sum_dtype) // binning**2
+    return binned_raw_image
+
@@ -0,0 +1,9 @@
+import numpy as np
+
+
+def get_buffer(buffers, key, shape, dtype):
+    buffer = buffers.get(key)
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        buffer = np.empty(shape, dtype=dtype)
+        buffers[key] = buffer
+    return buffer
@@ -0,0 +1,13 @@
+import json
+import hashlib
+
+import numpy as np
+
+
+def get_fingerprint(value):
+    def default(obj):
+        if isinstance(obj, np.ndarray):
+            return hashlib.sha1(np.ascontiguousarray(obj).tobytes()).hexdigest()
+        return repr(obj)
+
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=default).encode()).hexdigest()